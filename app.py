@@ -1,16 +1,50 @@
 # app.py - VERSIÓN CORREGIDA: GABINETES DINÁMICOS Y OCUPACIÓN MÚLTIPLE
 
-from flask import Flask, request, jsonify, session, make_response
+from flask import Flask, request, jsonify, session, make_response, Response, stream_with_context, g, has_app_context, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user, login_required
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from flask.sessions import SecureCookieSessionInterface
+from datetime import datetime, timedelta, date
 from config import Config
 import json
+import csv
+import click
+import io
+import base64
+import threading
+import logging
+import logging.handlers
+import queue
+import atexit
+import sys
+import random
+import cProfile
+import pstats
+import time as reloj
+import gzip
+import zlib
+import hashlib
+import mimetypes
+import re
+from collections import deque
+from bisect import bisect_left
 from flask_cors import CORS
+from functools import wraps
 import os
-from flask import send_from_directory, send_file 
+from flask import send_from_directory
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import or_, and_, func, event, inspect, insert, update
+from sqlalchemy.orm import joinedload
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+try:
+    import brotli  # Opcional: variantes br de activos y respuestas
+except ImportError:
+    brotli = None
 
 # Inicialización de la aplicación
 app = Flask(__name__)
@@ -40,6 +74,9 @@ CORS(app,
      methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
      allow_headers=["Content-Type", "Authorization", "X-Requested-With"])
 
+# Respuestas que el navegador no debe guardar (el resto de rutas fija su propia política)
+RUTAS_SIN_ALMACENAR = ('/api/', '/login', '/logout', '/metrics')
+
 # Headers CORS para todas las respuestas
 @app.after_request
 def after_request(response):
@@ -52,9 +89,16 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
     response.headers.add('Access-Control-Allow-Credentials', 'true')
     
-    response.headers.add('Cache-Control', 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0')
-    response.headers.add('Pragma', 'no-cache')
-    response.headers.add('Expires', '0')
+    if 'Cache-Control' in response.headers:
+        pass  # La ruta ya fijó su política (activos con huella, páginas HTML, archivos sueltos)
+    elif response.headers.get('ETag'):
+        # Listados versionados: el navegador puede guardarlos pero debe revalidar con If-None-Match
+        response.headers['Cache-Control'] = 'private, no-cache'
+    elif request.path.startswith(RUTAS_SIN_ALMACENAR):
+        # Datos de pacientes y sesión: nunca se guardan en disco
+        response.headers.add('Cache-Control', 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0')
+        response.headers.add('Pragma', 'no-cache')
+        response.headers.add('Expires', '0')
     
     return response
 
@@ -71,6 +115,321 @@ def options_handler(path=None):
     response.headers.add('Access-Control-Allow-Credentials', 'true')
     return response
 
+# ----------------------------------------------------
+# 📝 Logging en cola (las rutas solo encolan; un hilo escribe)
+# ----------------------------------------------------
+
+LOG_NIVEL = os.environ.get('LOG_NIVEL', 'INFO').upper()
+LOG_FORMATO = os.environ.get('LOG_FORMATO', 'texto')  # 'texto' o 'json'
+CAMPOS_REGISTRO_ESTANDAR = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+class FormateadorJSON(logging.Formatter):
+    """Una línea JSON por registro, con los campos pasados en `extra`"""
+
+    def format(self, record):
+        datos = {
+            'fecha': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'mensaje': record.getMessage()
+        }
+        datos.update({k: v for k, v in vars(record).items() if k not in CAMPOS_REGISTRO_ESTANDAR})
+        if record.exc_info:
+            datos['excepcion'] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+def configurar_logging():
+    """
+    El logger de la aplicación solo deja el registro en una cola en memoria; un QueueListener
+    en segundo plano lo formatea y lo escribe, así una terminal o pipe lento no bloquea peticiones.
+    """
+    registro = logging.getLogger('optometria')
+    if registro.handlers:
+        return registro
+
+    salida = logging.StreamHandler(sys.stderr)
+    if LOG_FORMATO == 'json':
+        salida.setFormatter(FormateadorJSON())
+    else:
+        salida.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    cola = queue.SimpleQueue()
+    oyente = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+    registro.addHandler(logging.handlers.QueueHandler(cola))
+    # Un LOG_NIVEL mal escrito no debe impedir que la app arranque
+    nivel_valido = isinstance(logging.getLevelName(LOG_NIVEL), int)
+    registro.setLevel(LOG_NIVEL if nivel_valido else logging.INFO)
+    registro.propagate = False
+    oyente.start()
+    atexit.register(oyente.stop)
+    if not nivel_valido:
+        registro.warning('LOG_NIVEL %r no es un nivel válido; se usa INFO', LOG_NIVEL)
+    return registro
+
+logger = configurar_logging()
+
+# ----------------------------------------------------
+# 📊 Métricas de peticiones y SQL (formato Prometheus en /metrics)
+# ----------------------------------------------------
+
+class Metricas:
+    """
+    Contadores e histogramas en memoria del proceso. Registrar un valor es una búsqueda
+    binaria y unas sumas bajo un lock, para que el costo en la ruta crítica sea despreciable.
+    """
+
+    LIMITES_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histogramas = {}  # (nombre, etiquetas) -> [conteos por límite..., suma, total]
+        self._contadores = {}   # (nombre, etiquetas) -> valor
+
+    def observar(self, nombre, etiquetas, valor):
+        indice = bisect_left(self.LIMITES_LATENCIA, valor)
+        clave = (nombre, etiquetas)
+        with self._lock:
+            datos = self._histogramas.get(clave)
+            if datos is None:
+                datos = self._histogramas[clave] = [0] * len(self.LIMITES_LATENCIA) + [0.0, 0]
+            if indice < len(self.LIMITES_LATENCIA):
+                datos[indice] += 1
+            datos[-2] += valor
+            datos[-1] += 1
+
+    def incrementar(self, nombre, etiquetas, valor=1):
+        clave = (nombre, etiquetas)
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    @staticmethod
+    def _formatear_etiquetas(etiquetas, extra=()):
+        pares = tuple(etiquetas) + tuple(extra)
+        if not pares:
+            return ''
+        escapar = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escapar(v)}"' for k, v in pares) + '}'
+
+    def exportar(self):
+        """Texto en formato de exposición de Prometheus"""
+        with self._lock:
+            histogramas = {k: list(v) for k, v in self._histogramas.items()}
+            contadores = dict(self._contadores)
+
+        lineas = []
+        for nombre in sorted({n for n, _ in histogramas}):
+            lineas.append(f'# TYPE {nombre} histogram')
+            for (n, etiquetas), datos in sorted(histogramas.items()):
+                if n != nombre:
+                    continue
+                acumulado = 0
+                for limite, conteo in zip(self.LIMITES_LATENCIA, datos):
+                    acumulado += conteo
+                    lineas.append(f'{nombre}_bucket{self._formatear_etiquetas(etiquetas, [("le", limite)])} {acumulado}')
+                lineas.append(f'{nombre}_bucket{self._formatear_etiquetas(etiquetas, [("le", "+Inf")])} {datos[-1]}')
+                lineas.append(f'{nombre}_sum{self._formatear_etiquetas(etiquetas)} {datos[-2]}')
+                lineas.append(f'{nombre}_count{self._formatear_etiquetas(etiquetas)} {datos[-1]}')
+        for nombre in sorted({n for n, _ in contadores}):
+            lineas.append(f'# TYPE {nombre} counter')
+            for (n, etiquetas), valor in sorted(contadores.items()):
+                if n == nombre:
+                    lineas.append(f'{nombre}{self._formatear_etiquetas(etiquetas)} {valor}')
+        return '\n'.join(lineas) + '\n'
+
+metricas = Metricas()
+
+def registrar_reserva(endpoint, resultado):
+    """Resultado de una reserva: exito, lleno (sin gabinetes) o error"""
+    metricas.incrementar('optometria_reservas_total', (('endpoint', endpoint), ('resultado', resultado)))
+
+@app.before_request
+def iniciar_medicion():
+    g.medicion = {'inicio': reloj.perf_counter(), 'sql_sentencias': 0, 'sql_segundos': 0.0}
+
+@app.after_request
+def registrar_medicion(response):
+    medicion = g.get('medicion')
+    if medicion is None:
+        return response
+    etiquetas = (
+        ('ruta', request.url_rule.rule if request.url_rule else 'sin_ruta'),
+        ('metodo', request.method)
+    )
+    codigo = response.status_code
+
+    def registrar():
+        metricas.observar('optometria_http_peticion_segundos', etiquetas,
+                          reloj.perf_counter() - medicion['inicio'])
+        metricas.incrementar('optometria_http_respuestas_total', etiquetas + (('codigo', codigo),))
+        metricas.incrementar('optometria_sql_sentencias_total', etiquetas, medicion['sql_sentencias'])
+        metricas.incrementar('optometria_sql_segundos_total', etiquetas, medicion['sql_segundos'])
+
+    if response.is_streamed:
+        # Los streams se registran al cerrarse para incluir todo su tiempo y su SQL
+        response.call_on_close(registrar)
+    else:
+        registrar()
+    return response
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _inicio_sentencia(conn, cursor, sentencia, parametros, contexto, executemany):
+    # Se guarda en el contexto de ejecución, que vive lo que la sentencia: si falla (p. ej. el
+    # IntegrityError de los reintentos de reserva) after_cursor_execute no se dispara y en la
+    # conexión del pool quedaría un inicio huérfano por cada error
+    if contexto is not None:
+        contexto.inicio_sentencia = reloj.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _fin_sentencia(conn, cursor, sentencia, parametros, contexto, executemany):
+    inicio = getattr(contexto, 'inicio_sentencia', None)
+    if inicio is None:
+        return
+    duracion = reloj.perf_counter() - inicio
+    medicion = g.get('medicion') if has_app_context() else None
+    if medicion is not None:
+        medicion['sql_sentencias'] += 1
+        medicion['sql_segundos'] += duracion
+    if duracion * 1000 >= diagnostico['sql_lenta_umbral_ms']:
+        registrar_consulta_lenta(sentencia, parametros, duracion)
+
+@app.route('/metrics', methods=['GET'])
+def exportar_metricas():
+    return Response(metricas.exportar(), mimetype='text/plain; version=0.0.4')
+
+# ----------------------------------------------------
+# 🐢 Consultas lentas y perfilado bajo demanda
+# ----------------------------------------------------
+
+# Ajustables en caliente con PUT /api/diagnostico/configuracion
+diagnostico = {
+    'sql_lenta_umbral_ms': float(os.environ.get('SQL_LENTA_UMBRAL_MS', 200)),
+    'perfil_tasa_muestreo': float(os.environ.get('PERFIL_TASA_MUESTREO', 0)),  # 0 = solo con cabecera
+    'perfil_top_n': int(os.environ.get('PERFIL_TOP_N', 25))
+}
+PERFIL_CABECERA = 'X-Perfilar'
+DIAGNOSTICO_MAX_REGISTROS = 100
+LARGO_MAX_PARAMETROS = 500
+
+consultas_lentas = deque(maxlen=DIAGNOSTICO_MAX_REGISTROS)
+perfiles_guardados = deque(maxlen=DIAGNOSTICO_MAX_REGISTROS)
+
+def _ruta_actual():
+    if has_request_context() and request.url_rule:
+        return f'{request.method} {request.url_rule.rule}'
+    return 'sin_ruta'
+
+def _redactar_parametros(valor):
+    """Conserva la forma de los parámetros (claves, cantidad y tipos) sin sus valores"""
+    if isinstance(valor, dict):
+        return {clave: _redactar_parametros(v) for clave, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return [_redactar_parametros(v) for v in valor]
+    return None if valor is None else f'<{type(valor).__name__}>'
+
+def registrar_consulta_lenta(sentencia, parametros, duracion):
+    """Guarda SQL, parámetros (redactados y truncados), duración y ruta de origen de una sentencia lenta"""
+    # Los parámetros llevan nombres y teléfonos de pacientes: el registro solo muestra su forma
+    texto_parametros = repr(_redactar_parametros(parametros))
+    if len(texto_parametros) > LARGO_MAX_PARAMETROS:
+        texto_parametros = texto_parametros[:LARGO_MAX_PARAMETROS] + '...'
+    registro = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'duracion_ms': round(duracion * 1000, 2),
+        'ruta': _ruta_actual(),
+        'sentencia': sentencia,
+        'parametros': texto_parametros
+    }
+    consultas_lentas.append(registro)
+    logger.warning('SQL lenta (%s ms) en %s: %s', registro['duracion_ms'], registro['ruta'],
+                   ' '.join(sentencia.split())[:200],
+                   extra={'duracion_ms': registro['duracion_ms'], 'ruta': registro['ruta']})
+
+def _debe_perfilar():
+    if request.headers.get(PERFIL_CABECERA) == '1':
+        # La cabecera solo la respetan usuarios autenticados para no abrir un vector de carga
+        return 'cabecera' if current_user.is_authenticated else None
+    tasa = diagnostico['perfil_tasa_muestreo']
+    if tasa > 0 and random.random() < tasa:
+        return 'muestreo'
+    return None
+
+@app.before_request
+def iniciar_perfil():
+    motivo = _debe_perfilar()
+    if motivo is None:
+        return
+    perfil = cProfile.Profile()
+    try:
+        perfil.enable()
+    except ValueError:
+        # Ya hay otro perfilador activo en este hilo
+        return
+    g.perfil = {'perfil': perfil, 'motivo': motivo, 'inicio': reloj.perf_counter()}
+
+def guardar_perfil(datos, ruta, codigo):
+    """Detiene el perfilador y guarda las top-N funciones por tiempo acumulado"""
+    perfil = datos['perfil']
+    perfil.disable()
+    estadisticas = pstats.Stats(perfil).stats
+    funciones = sorted(estadisticas.items(), key=lambda item: item[1][3], reverse=True)
+    perfiles_guardados.append({
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'ruta': ruta,
+        'codigo': codigo,
+        'motivo': datos['motivo'],
+        'duracion_ms': round((reloj.perf_counter() - datos['inicio']) * 1000, 2),
+        'funciones': [
+            {
+                'funcion': f'{archivo}:{linea}({nombre})',
+                'llamadas': llamadas,
+                'tiempo_propio_ms': round(propio * 1000, 3),
+                'tiempo_acumulado_ms': round(acumulado * 1000, 3)
+            }
+            for (archivo, linea, nombre), (_, llamadas, propio, acumulado, _) in funciones[:diagnostico['perfil_top_n']]
+        ]
+    })
+
+@app.after_request
+def terminar_perfil(response):
+    datos = g.pop('perfil', None)
+    if datos is None:
+        return response
+    ruta, codigo = _ruta_actual(), response.status_code
+    if response.is_streamed:
+        response.call_on_close(lambda: guardar_perfil(datos, ruta, codigo))
+    else:
+        guardar_perfil(datos, ruta, codigo)
+    return response
+
+@app.route('/api/diagnostico/consultas_lentas', methods=['GET'])
+@login_required
+def listar_consultas_lentas():
+    return jsonify({
+        'umbral_ms': diagnostico['sql_lenta_umbral_ms'],
+        'consultas': list(reversed(consultas_lentas))
+    }), 200
+
+@app.route('/api/diagnostico/perfiles', methods=['GET'])
+@login_required
+def listar_perfiles():
+    return jsonify({'perfiles': list(reversed(perfiles_guardados))}), 200
+
+@app.route('/api/diagnostico/configuracion', methods=['GET', 'PUT'])
+@login_required
+def configurar_diagnostico():
+    if request.method == 'PUT':
+        data = request.get_json() or {}
+        try:
+            if 'sql_lenta_umbral_ms' in data:
+                diagnostico['sql_lenta_umbral_ms'] = max(0.0, float(data['sql_lenta_umbral_ms']))
+            if 'perfil_tasa_muestreo' in data:
+                diagnostico['perfil_tasa_muestreo'] = min(1.0, max(0.0, float(data['perfil_tasa_muestreo'])))
+            if 'perfil_top_n' in data:
+                diagnostico['perfil_top_n'] = max(1, int(data['perfil_top_n']))
+        except (TypeError, ValueError):
+            return jsonify({'message': 'Valores de configuración inválidos'}), 400
+    return jsonify(diagnostico), 200
+
 # Inicialización de extensiones
 db = SQLAlchemy(app)
 login_manager = LoginManager()
@@ -186,6 +545,16 @@ class Cita(db.Model):
     id_gabinete = db.Column(db.Integer, db.ForeignKey('gabinete.id_gabinete'), nullable=False)
     id_usuario = db.Column(db.Integer, db.ForeignKey('usuario.id_usuario'), nullable=True)
     estado = db.Column(db.String(20), default='Programada')
+    # Versión de la agenda en la que la cita se creó o modificó por última vez (/api/citas/cambios)
+    version_cambio = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        # Un gabinete solo puede tener una cita por fecha y hora (evita la doble reserva concurrente)
+        db.UniqueConstraint('fecha', 'hora', 'id_gabinete', name='uq_cita_horario_gabinete'),
+        # Búsquedas por horario, rangos de fechas de reportes y orden (fecha, hora, id_cita) del panel
+        db.Index('ix_cita_fecha_hora', 'fecha', 'hora'),
+        db.Index('ix_cita_version_cambio', 'version_cambio'),
+    )
     
     def to_dict(self):
         return {
@@ -197,8 +566,8 @@ class Cita(db.Model):
             'id_gabinete': self.id_gabinete,
             'estado': self.estado,
             'paciente': self.paciente.to_dict() if self.paciente else None,
-            'motivo': self.motivo.descripcion if self.motivo else 'N/A',
-            'gabinete': self.gabinete.nombre if self.gabinete else 'N/A'
+            'motivo': catalogos.descripcion_motivo(self.id_motivo),
+            'gabinete': catalogos.nombre_gabinete(self.id_gabinete)
         }
 
 # cita recurrente new model
@@ -222,6 +591,13 @@ class CitaRecurrenteDetalle(db.Model):
     id_cita = db.Column(db.Integer, db.ForeignKey('cita.id_cita'), nullable=False)
     fecha_programada = db.Column(db.Date, nullable=False)
     estado_individual = db.Column(db.String(20), default='Programada')  
+    version_cambio = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        db.Index('ix_detalle_id_cita', 'id_cita'),    # es_cita_recurrente / obtener_serie_de_cita
+        db.Index('ix_detalle_id_serie', 'id_serie'),  # cancelación de la serie completa
+        db.Index('ix_detalle_version_cambio', 'version_cambio'),
+    )
 
     def to_dict(self):
         return {
@@ -230,19 +606,468 @@ class CitaRecurrenteDetalle(db.Model):
             'estado': self.estado_individual
         }
 
+# Versión de la agenda: contador único que aumenta en cada commit que escribe citas o series
+class VersionAgenda(db.Model):
+    __tablename__ = 'version_agenda'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+# Estadística diaria pre-agregada: número de citas por fecha, gabinete, motivo y estado
+class EstadisticaDiaria(db.Model):
+    __tablename__ = 'estadistica_diaria'
+    fecha = db.Column(db.Date, primary_key=True)
+    id_gabinete = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    id_motivo = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    estado = db.Column(db.String(20), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+# Versión del esquema aplicada (ver migraciones en Funciones de Inicialización)
+class VersionEsquema(db.Model):
+    __tablename__ = 'version_esquema'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    descripcion = db.Column(db.String(120), nullable=False)
+    aplicada_en = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
 # ----------------------------------------------------
 # ⚙️ Funciones Auxiliares
 # ----------------------------------------------------
 
-def get_next_available_gabinete(fecha, hora):
+# ----------------------------------------------------
+# 🗂️ Índice en memoria de ocupación de gabinetes
+# ----------------------------------------------------
+# (fecha, hora) -> (instante de carga, frozenset de id_gabinete ocupados).
+# Se invalida por horario al confirmar (commit) o revertir cualquier cambio de Cita,
+# así que la base de datos solo se consulta en un fallo de caché. El TTL acota el
+# tiempo que puede quedar obsoleto si otro proceso escribe en la misma base.
+
+OCUPACION_TTL_SEGUNDOS = 30
+OCUPACION_MAX_HORARIOS = 5000
+
+_ocupacion_slots = {}
+_ocupacion_lock = threading.Lock()
+
+def obtener_gabinetes_ocupados(fecha, hora):
+    """Retorna el conjunto de gabinetes ocupados en (fecha, hora), desde memoria si es posible"""
+    clave = (fecha, hora)
+    ahora = reloj.monotonic()
+    with _ocupacion_lock:
+        entrada = _ocupacion_slots.get(clave)
+    if entrada and ahora - entrada[0] < OCUPACION_TTL_SEGUNDOS:
+        return entrada[1]
+
+    filas = db.session.query(Cita.id_gabinete).filter_by(fecha=fecha, hora=hora).all()
+    ocupados = frozenset(id_gabinete for (id_gabinete,) in filas)
+    with _ocupacion_lock:
+        if len(_ocupacion_slots) >= OCUPACION_MAX_HORARIOS:
+            _ocupacion_slots.clear()
+        _ocupacion_slots[clave] = (ahora, ocupados)
+    return ocupados
+
+def invalidar_ocupacion(slots=None):
+    """Descarta del índice los horarios indicados, o todo el índice si no se indican"""
+    with _ocupacion_lock:
+        if slots is None:
+            _ocupacion_slots.clear()
+        else:
+            for clave in slots:
+                _ocupacion_slots.pop(clave, None)
+
+@event.listens_for(db.session, 'before_flush')
+def _registrar_slots_modificados(sesion, contexto, instancias):
+    """Anota en la sesión los horarios (anteriores y nuevos) de las citas que se escriben"""
+    slots = sesion.info.setdefault('slots_ocupacion', set())
+    for obj in list(sesion.new) + list(sesion.deleted):
+        if isinstance(obj, Cita):
+            slots.add((obj.fecha, obj.hora))
+    for obj in sesion.dirty:
+        if isinstance(obj, Cita):
+            estado = inspect(obj)
+            fechas = set(estado.attrs.fecha.history.deleted or ()) | {obj.fecha}
+            horas = set(estado.attrs.hora.history.deleted or ()) | {obj.hora}
+            slots.update((f, h) for f in fechas for h in horas)
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidar_slots_confirmados(sesion):
+    if sesion.in_nested_transaction():
+        return  # SAVEPOINT liberado: los cambios aún no son visibles para otros
+    invalidar_ocupacion(sesion.info.pop('slots_ocupacion', set()))
+
+@event.listens_for(db.session, 'after_rollback')
+def _invalidar_slots_revertidos(sesion):
+    # Un flush revertido pudo haber poblado el índice con filas que ya no existen.
+    # Si solo se revirtió un SAVEPOINT, los horarios del resto de la transacción se conservan
+    if sesion.in_nested_transaction():
+        invalidar_ocupacion(sesion.info.get('slots_ocupacion', set()))
+    else:
+        invalidar_ocupacion(sesion.info.pop('slots_ocupacion', set()))
+
+# ----------------------------------------------------
+# 🗂️ Catálogos de referencia en memoria (gabinetes, motivos, roles)
+# ----------------------------------------------------
+# Son tablas de unas pocas filas sembradas en inicializar_db: se cargan una vez al arrancar
+# y se recargan (en la siguiente lectura) cuando una transacción confirmada las modifica.
+
+MODELOS_CATALOGO = (Gabinete, MotivoCita, Rol)
+
+class CatalogosReferencia:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._datos = None  # {'gabinetes': {id: nombre}, 'motivos': {id: descripcion}, 'roles': {id: nombre_rol}}
+
+    def cargar(self):
+        """Lee las tres tablas (requiere contexto de aplicación) y reemplaza la copia en memoria"""
+        datos = {
+            'gabinetes': dict(db.session.query(Gabinete.id_gabinete, Gabinete.nombre).all()),
+            'motivos': dict(db.session.query(MotivoCita.id_motivo, MotivoCita.descripcion).all()),
+            'roles': dict(db.session.query(Rol.id_rol, Rol.nombre_rol).all())
+        }
+        with self._lock:
+            self._datos = datos
+        return datos
+
+    def invalidar(self):
+        with self._lock:
+            self._datos = None
+
+    def _obtener(self, tabla):
+        datos = self._datos
+        if datos is None:
+            datos = self.cargar()
+        return datos[tabla]
+
+    @property
+    def gabinetes(self):
+        return self._obtener('gabinetes')
+
+    @property
+    def motivos(self):
+        return self._obtener('motivos')
+
+    @property
+    def roles(self):
+        return self._obtener('roles')
+
+    def nombre_gabinete(self, id_gabinete):
+        return self.gabinetes.get(id_gabinete, 'N/A')
+
+    def descripcion_motivo(self, id_motivo):
+        return self.motivos.get(id_motivo, 'N/A')
+
+    def nombre_rol(self, id_rol):
+        return self.roles.get(id_rol)
+
+catalogos = CatalogosReferencia()
+
+@event.listens_for(db.session, 'before_flush')
+def _detectar_cambios_catalogo(sesion, contexto, instancias):
+    if any(isinstance(obj, MODELOS_CATALOGO)
+           for obj in list(sesion.new) + list(sesion.dirty) + list(sesion.deleted)):
+        sesion.info['catalogos_modificados'] = True
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidar_catalogos_confirmados(sesion):
+    if sesion.in_nested_transaction():
+        return
+    if sesion.info.pop('catalogos_modificados', False):
+        catalogos.invalidar()
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_cambios_catalogo(sesion):
+    if sesion.in_nested_transaction():
+        return  # SAVEPOINT revertido: lo anotado por el resto de la transacción sigue vigente
+    sesion.info.pop('catalogos_modificados', None)
+
+# ----------------------------------------------------
+# 🏷️ Versión de la agenda y ETag de listados
+# ----------------------------------------------------
+
+MODELOS_AGENDA = (Cita, CitaRecurrente, CitaRecurrenteDetalle)
+
+def registrar_cambios_agenda(sesion, objetos=()):
+    """
+    Indica que la transacción actual escribe en la agenda. Las citas y detalles indicados
+    (y los que pasan por flush) se marcan con la nueva versión al confirmar.
+    Se llama explícitamente en las inserciones en bloque, que no pasan por before_flush.
+    """
+    sesion.info['agenda_modificada'] = True
+    sesion.info.setdefault('objetos_agenda', set()).update(objetos)
+
+@event.listens_for(db.session, 'before_flush')
+def _detectar_cambios_agenda(sesion, contexto, instancias):
+    cambiados = [
+        obj for obj in list(sesion.new) + list(sesion.dirty) + list(sesion.deleted)
+        if isinstance(obj, MODELOS_AGENDA)
+    ]
+    if cambiados:
+        registrar_cambios_agenda(sesion, (
+            obj for obj in cambiados if isinstance(obj, (Cita, CitaRecurrenteDetalle))
+        ))
+
+@event.listens_for(db.session, 'before_commit')
+def _incrementar_version_agenda(sesion):
+    # El incremento se hace justo antes del COMMIT para que el bloqueo de la fila del
+    # contador dure solo lo que dura el propio commit; como ese bloqueo ordena los
+    # commits, las versiones quedan visibles en orden y sin huecos
+    if sesion.in_nested_transaction():
+        return
+    sesion.flush()
+    objetos = sesion.info.pop('objetos_agenda', set())
+    if not sesion.info.pop('agenda_modificada', False):
+        return
+    resultado = sesion.execute(
+        update(VersionAgenda).where(VersionAgenda.id == 1).values(version=VersionAgenda.version + 1)
+    )
+    if resultado.rowcount == 0:
+        sesion.add(VersionAgenda(id=1, version=1))
+        sesion.flush()
+    version = sesion.query(VersionAgenda.version).filter_by(id=1).scalar()
+    sesion.info['version_confirmada'] = version
+
+    # Solo objetos que siguen en la base (un SAVEPOINT revertido los deja transitorios)
+    vigentes = [obj for obj in objetos if inspect(obj).persistent]
+    ids_citas = [obj.id_cita for obj in vigentes if isinstance(obj, Cita)]
+    ids_detalles = [obj.id_detalle for obj in vigentes if isinstance(obj, CitaRecurrenteDetalle)]
+    sin_sincronizar = {'synchronize_session': False}
+    if ids_citas:
+        sesion.execute(
+            update(Cita).where(Cita.id_cita.in_(ids_citas)).values(version_cambio=version),
+            execution_options=sin_sincronizar
+        )
+    if ids_citas or ids_detalles:
+        # Los detalles insertados en bloque se identifican por su cita
+        sesion.execute(
+            update(CitaRecurrenteDetalle).where(or_(
+                CitaRecurrenteDetalle.id_cita.in_(ids_citas),
+                CitaRecurrenteDetalle.id_detalle.in_(ids_detalles)
+            )).values(version_cambio=version),
+            execution_options=sin_sincronizar
+        )
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_cambios_agenda(sesion):
+    if sesion.in_nested_transaction():
+        return  # SAVEPOINT revertido: sus objetos quedan transitorios y se ignoran al confirmar
+    sesion.info.pop('agenda_modificada', None)
+    sesion.info.pop('objetos_agenda', None)
+
+# ----------------------------------------------------
+# 📈 Mantenimiento incremental de la estadística diaria
+# ----------------------------------------------------
+
+def _clave_estadistica(fecha, id_gabinete, id_motivo, estado):
+    # Las citas sin estado explícito reciben 'Programada' al insertarse
+    return (fecha, id_gabinete, id_motivo, estado or 'Programada')
+
+def acumular_estadistica(sesion, clave, delta):
+    """Suma `delta` al contador de la clave; se escribe en la base al confirmar"""
+    deltas = sesion.info.setdefault('deltas_estadistica', {})
+    deltas[clave] = deltas.get(clave, 0) + delta
+
+@event.listens_for(db.session, 'after_flush')
+def _calcular_deltas_estadistica(sesion, contexto):
+    # after_flush: solo cuentan las escrituras que llegaron a la base (un INSERT que viola
+    # uq_cita_horario_gabinete no suma), y new/dirty/deleted y el historial siguen intactos
+    for obj in sesion.new:
+        if isinstance(obj, Cita):
+            acumular_estadistica(sesion, _clave_estadistica(obj.fecha, obj.id_gabinete, obj.id_motivo, obj.estado), 1)
+    for obj in sesion.deleted:
+        if isinstance(obj, Cita):
+            acumular_estadistica(sesion, _clave_estadistica(obj.fecha, obj.id_gabinete, obj.id_motivo, obj.estado), -1)
+    for obj in sesion.dirty:
+        if not isinstance(obj, Cita):
+            continue
+        estado = inspect(obj)
+
+        def anterior(atributo):
+            historial = estado.attrs[atributo].history
+            return historial.deleted[0] if historial.deleted else getattr(obj, atributo)
+
+        antes = _clave_estadistica(anterior('fecha'), anterior('id_gabinete'), anterior('id_motivo'), anterior('estado'))
+        despues = _clave_estadistica(obj.fecha, obj.id_gabinete, obj.id_motivo, obj.estado)
+        if antes != despues:
+            acumular_estadistica(sesion, antes, -1)
+            acumular_estadistica(sesion, despues, 1)
+
+@event.listens_for(db.session, 'before_commit')
+def _aplicar_deltas_estadistica(sesion):
+    if sesion.in_nested_transaction():
+        return
+    sesion.flush()
+    deltas = {clave: d for clave, d in sesion.info.pop('deltas_estadistica', {}).items() if d}
+    if not deltas:
+        return
+
+    tabla = EstadisticaDiaria.__table__
+    filas = [
+        {'fecha': f, 'id_gabinete': g, 'id_motivo': m, 'estado': e, 'total': d}
+        for (f, g, m, e), d in deltas.items()
+    ]
+    dialecto = sesion.get_bind().dialect.name
+    # Upsert multi-fila en una sola sentencia: total = total + delta
+    if dialecto == 'mysql':
+        sentencia = mysql_insert(tabla).values(filas)
+        sesion.execute(sentencia.on_duplicate_key_update(total=tabla.c.total + sentencia.inserted.total))
+    elif dialecto == 'sqlite':
+        sentencia = sqlite_insert(tabla).values(filas)
+        sesion.execute(sentencia.on_conflict_do_update(
+            index_elements=[tabla.c.fecha, tabla.c.id_gabinete, tabla.c.id_motivo, tabla.c.estado],
+            set_={'total': tabla.c.total + sentencia.excluded.total}
+        ))
+    else:
+        for fila in filas:
+            resultado = sesion.execute(tabla.update().where(and_(
+                tabla.c.fecha == fila['fecha'], tabla.c.id_gabinete == fila['id_gabinete'],
+                tabla.c.id_motivo == fila['id_motivo'], tabla.c.estado == fila['estado']
+            )).values(total=tabla.c.total + fila['total']))
+            if resultado.rowcount == 0:
+                sesion.execute(tabla.insert().values(fila))
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_deltas_estadistica(sesion):
+    if sesion.in_nested_transaction():
+        return  # SAVEPOINT revertido: los deltas solo se anotan tras un flush exitoso
+    sesion.info.pop('deltas_estadistica', None)
+
+def recalcular_estadisticas():
+    """Reconstruye la estadística diaria completa a partir de Cita con un INSERT ... SELECT"""
+    estado = func.coalesce(Cita.estado, 'Programada')
+    db.session.execute(EstadisticaDiaria.__table__.delete())
+    db.session.execute(insert(EstadisticaDiaria).from_select(
+        ['fecha', 'id_gabinete', 'id_motivo', 'estado', 'total'],
+        db.select(Cita.fecha, Cita.id_gabinete, Cita.id_motivo, estado, func.count(Cita.id_cita))
+        .group_by(Cita.fecha, Cita.id_gabinete, Cita.id_motivo, estado)
+    ))
+    db.session.commit()
+    return db.session.query(func.count()).select_from(EstadisticaDiaria).scalar()
+
+def obtener_version_agenda():
+    """Versión actual de la agenda (0 si aún no hay escrituras)"""
+    return db.session.query(VersionAgenda.version).filter_by(id=1).scalar() or 0
+
+def con_etag_agenda(vista):
+    """
+    Etiqueta la respuesta con la versión de la agenda y responde 304 sin consultar
+    Cita cuando el cliente ya tiene esa versión (If-None-Match).
+    """
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        # La versión se lee ANTES que los datos: si una escritura ocurre en medio, la
+        # respuesta queda con una versión anterior y el cliente volverá a descargarla
+        # Incluye el día porque el reporte semanal cambia de ventana a medianoche
+        version = obtener_version_agenda()
+        etiqueta = f"agenda-{version}-{date.today().isoformat()}"
+
+        # Comparación débil: la respuesta comprimida lleva la etiqueta como W/"..."
+        if request.if_none_match.contains_weak(etiqueta):
+            respuesta = make_response('', 304)
+            respuesta.set_etag(etiqueta)
+            respuesta.headers['X-Version-Agenda'] = str(version)
+            return respuesta
+
+        respuesta = make_response(vista(*args, **kwargs))
+        if respuesta.status_code == 200:
+            respuesta.set_etag(etiqueta)
+            # Versión desde la que el panel debe pedir /api/citas/cambios?since=...
+            respuesta.headers['X-Version-Agenda'] = str(version)
+        return respuesta
+    return envoltura
+
+# ----------------------------------------------------
+# 📡 Canal de eventos de la agenda (Server-Sent Events)
+# ----------------------------------------------------
+
+class CanalEventosAgenda:
+    """
+    Difusión de eventos a los paneles conectados. Todos los clientes leen del mismo
+    búfer circular con su propio cursor, así que publicar cuesta O(1) y la memoria no
+    crece con el número de clientes; cada evento se serializa una sola vez.
+    """
+
+    def __init__(self, capacidad=500, max_clientes=200):
+        self._eventos = deque(maxlen=capacidad)  # (secuencia, texto SSE ya formateado)
+        self._secuencia = 0
+        self._condicion = threading.Condition()
+        self._clientes = 0
+        self.max_clientes = max_clientes
+        self.ultima_version = 0
+
+    def publicar(self, tipo, datos, version=None):
+        with self._condicion:
+            self._secuencia += 1
+            if version:
+                self.ultima_version = max(self.ultima_version, version)
+                datos = dict(datos, version=version)
+            texto = f"id: {self._secuencia}\nevent: {tipo}\ndata: {json.dumps(datos, default=str)}\n\n"
+            self._eventos.append((self._secuencia, texto))
+            self._condicion.notify_all()
+
+    def conectar(self):
+        with self._condicion:
+            if self._clientes >= self.max_clientes:
+                return False
+            self._clientes += 1
+            return True
+
+    def desconectar(self):
+        with self._condicion:
+            self._clientes -= 1
+
+    @property
+    def secuencia(self):
+        return self._secuencia
+
+    def esperar(self, desde, timeout):
+        """
+        Espera eventos posteriores a la secuencia `desde`. Retorna la lista (vacía si
+        venció el tiempo) o None si el cliente se quedó atrás y debe recargar la agenda.
+        """
+        with self._condicion:
+            if desde > self._secuencia:
+                # Last-Event-ID de otro proceso o de antes de un reinicio: el cursor no sirve
+                return None
+            if self._secuencia <= desde:
+                self._condicion.wait(timeout)
+            if self._eventos and desde < self._eventos[0][0] - 1:
+                return None
+            return [evento for evento in self._eventos if evento[0] > desde]
+
+SSE_INTERVALO_LATIDO = 15       # segundos entre comentarios keep-alive
+SSE_INTERVALO_VIGILANCIA = 5    # segundos entre lecturas de la versión en la base
+
+canal_agenda = CanalEventosAgenda()
+_vigilante_iniciado = threading.Event()
+
+def publicar_evento_agenda(tipo, datos):
+    """Publica un evento tras un commit exitoso, con la versión que dejó ese commit"""
+    canal_agenda.publicar(tipo, datos, db.session.info.get('version_confirmada'))
+
+def _vigilar_version_agenda():
+    """
+    Un único hilo por proceso detecta commits hechos por otros procesos (otra instancia
+    de la app) comparando la versión de la agenda, y avisa a los clientes de este.
+    """
+    while True:
+        reloj.sleep(SSE_INTERVALO_VIGILANCIA)
+        try:
+            with app.app_context():
+                version = obtener_version_agenda()
+                db.session.remove()
+        except Exception as e:
+            logger.warning('No se pudo leer la versión de la agenda: %s', e)
+            continue
+        if version > canal_agenda.ultima_version:
+            canal_agenda.publicar('agenda_actualizada', {}, version)
+
+def get_next_available_gabinete(fecha, hora, excluir=()):
     """
     Busca el primer gabinete disponible (del 1 al 6) para una fecha y hora específicas.
+    Los gabinetes en `excluir` se tratan como ocupados (p. ej. los que perdieron una carrera).
     Retorna el ID del gabinete o None si todos están llenos.
     """
+    inicio = reloj.perf_counter()
     try:
         # 1. Obtener qué gabinetes ya están ocupados a esa hora específica
-        citas_en_ese_horario = Cita.query.filter_by(fecha=fecha, hora=hora).all()
-        gabinetes_ocupados = {c.id_gabinete for c in citas_en_ese_horario}
+        gabinetes_ocupados = obtener_gabinetes_ocupados(fecha, hora) | set(excluir)
         
         # 2. Obtener la lista total de gabinetes desde la Configuración
         todos_gabinetes = [g['id'] for g in Config.GABINETES]
@@ -250,23 +1075,67 @@ def get_next_available_gabinete(fecha, hora):
         # 3. Buscar el primero que NO esté en la lista de ocupados
         for g_id in todos_gabinetes:
             if g_id not in gabinetes_ocupados:
-                print(f"✅ Gabinete {g_id} disponible para {fecha} {hora}")
+                logger.debug('Gabinete %s disponible para %s %s', g_id, fecha, hora)
                 return g_id
                 
-        print(f"❌ Todos los gabinetes ocupados para {fecha} {hora}")
+        logger.info('Todos los gabinetes ocupados para %s %s', fecha, hora)
         return None # Indica que ya no hay lugar
         
-    except Exception as e:
-        print(f"❌ Error calculando gabinete disponible: {e}")
+    except Exception:
+        logger.exception('Error calculando gabinete disponible para %s %s', fecha, hora)
         return None
+    finally:
+        metricas.observar('optometria_gabinete_asignacion_segundos', (), reloj.perf_counter() - inicio)
 
 def verificar_disponibilidad_fecha(fecha, hora):
     """Verifica si hay AL MENOS UN gabinete disponible en esa fecha y hora"""
-    citas_existentes = Cita.query.filter_by(fecha=fecha, hora=hora).count()
+    citas_existentes = len(obtener_gabinetes_ocupados(fecha, hora))
     total_gabinetes = len(Config.GABINETES)
     # Retorna True (disponible) si hay menos citas que gabinetes
     return citas_existentes < total_gabinetes
 
+def reservar_gabinete(fecha, hora, **datos_cita):
+    """
+    Inserta una Cita en el primer gabinete libre de forma optimista: si otra petición
+    ganó ese gabinete (violación de uq_cita_horario_gabinete) se revierte solo el
+    SAVEPOINT y se intenta con el siguiente. Retorna la Cita creada o None si está lleno.
+    """
+    perdidos = set()
+    for _ in range(len(Config.GABINETES)):
+        id_gabinete = get_next_available_gabinete(fecha, hora, excluir=perdidos)
+        if id_gabinete is None:
+            return None
+
+        cita = Cita(fecha=fecha, hora=hora, id_gabinete=id_gabinete, **datos_cita)
+        try:
+            with db.session.begin_nested():
+                db.session.add(cita)
+        except IntegrityError:
+            perdidos.add(id_gabinete)
+            invalidar_ocupacion([(fecha, hora)])
+            continue
+        return cita
+    return None
+
+def reubicar_gabinete_si_ocupado(cita):
+    """
+    Tras cambiar la fecha u hora de una cita, conserva su gabinete si sigue libre
+    en el nuevo horario o la mueve al siguiente disponible. Retorna False si no hay lugar.
+    """
+    estado = inspect(cita)
+    if not (estado.attrs.fecha.history.has_changes() or estado.attrs.hora.history.has_changes()):
+        return True
+
+    # Sin autoflush: la cita aún no debe escribirse en su nuevo horario
+    with db.session.no_autoflush:
+        if cita.id_gabinete not in obtener_gabinetes_ocupados(cita.fecha, cita.hora):
+            return True
+        id_gabinete = get_next_available_gabinete(cita.fecha, cita.hora)
+    if id_gabinete is None:
+        return False
+    cita.id_gabinete = id_gabinete
+    return True
+
 def calcular_fecha_fin(fecha_inicio, meses=3):
     """Calcula la fecha fin sumando meses a la fecha inicio"""
     from dateutil.relativedelta import relativedelta
@@ -279,53 +1148,118 @@ def encontrar_proximo_dia(fecha, dia_semana):
         dias_restantes = 7  # Ir a la siguiente semana
     return fecha + timedelta(days=dias_restantes)
 
-def generar_citas_recurrentes(id_serie, id_paciente, fecha_inicio, fecha_fin, dia_semana, hora, id_usuario):
-    """Genera todas las citas recurrentes para la serie (EXCLUYENDO la fecha original)"""
-    citas_generadas = []
-    fecha_actual = fecha_inicio
-    semana_numero = 0
-    
-    # Ajuste para iniciar en la semana siguiente a la original
-    fecha_actual += timedelta(days=7)
+def _insertar_citas_en_bloque(fechas_objetivo, id_paciente, hora, id_usuario):
+    """
+    Asigna en memoria el primer gabinete libre de cada fecha (una sola consulta de
+    ocupación) e inserta todas las citas con un INSERT en bloque. Si otra petición ocupa
+    alguno de esos gabinetes entretanto, el INSERT falla con IntegrityError.
+    """
+    ocupacion = {}
+    filas = db.session.query(Cita.fecha, Cita.id_gabinete).filter(
+        Cita.hora == hora,
+        Cita.fecha.in_([fecha for _, fecha in fechas_objetivo])
+    ).all()
+    for fecha, id_gabinete in filas:
+        ocupacion.setdefault(fecha, set()).add(id_gabinete)
+
+    todos_gabinetes = [g['id'] for g in Config.GABINETES]
+    filas_citas = []
+    for semana_numero, fecha in fechas_objetivo:
+        ocupados = ocupacion.get(fecha, set())
+        id_gabinete = next((g_id for g_id in todos_gabinetes if g_id not in ocupados), None)
+        if id_gabinete is None:
+            continue
+
+        filas_citas.append({
+            'fecha': fecha,
+            'hora': hora,
+            'id_paciente': id_paciente,
+            'id_motivo': 3,  # Terapia visual
+            'id_gabinete': id_gabinete,
+            'estado': 'Programada',
+            'id_usuario': id_usuario
+        })
+        logger.debug('Semana %s: %s - Gabinete %s', semana_numero, fecha, id_gabinete)
+
+    if not filas_citas:
+        return []
+
+    # INSERT en bloque (executemany / multi-fila) en lugar de un flush por cita
+    db.session.execute(insert(Cita), filas_citas)
+    # El bloque no pasa por before_flush: se registran sus horarios para el índice de ocupación
+    db.session.info.setdefault('slots_ocupacion', set()).update(
+        (fila['fecha'], hora) for fila in filas_citas
+    )
+
+    # Se recuperan los IDs generados con una sola consulta; (fecha, gabinete) identifica
+    # cada cita nueva porque el gabinete se eligió libre en esa fecha y hora
+    asignados = {(fila['fecha'], fila['id_gabinete']) for fila in filas_citas}
+    citas_generadas = [
+        cita for cita in Cita.query.filter(
+            Cita.hora == hora,
+            Cita.id_paciente == id_paciente,
+            Cita.id_motivo == 3,
+            Cita.fecha.in_([fila['fecha'] for fila in filas_citas])
+        ).order_by(Cita.fecha).all()
+        if (cita.fecha, cita.id_gabinete) in asignados
+    ]
+
+    registrar_cambios_agenda(db.session, citas_generadas)
+    for fila in filas_citas:
+        acumular_estadistica(db.session, _clave_estadistica(fila['fecha'], fila['id_gabinete'], 3, 'Programada'), 1)
+    return citas_generadas
+
+def generar_citas_recurrentes(id_serie, id_paciente, fecha_inicio, fecha_fin, dia_semana, hora, id_usuario,
+                              por_semana=False):
+    """
+    Genera todas las citas recurrentes para la serie (EXCLUYENDO la fecha original).
+    La ocupación de todas las fechas se lee en una sola consulta, los gabinetes se
+    deciden en memoria y las citas y sus detalles se insertan en bloque, por lo que
+    el número de consultas no depende del número de semanas.
+
+    Con `por_semana` cada cita se reserva con reservar_gabinete, que descarta los gabinetes
+    que pierde ante otra petición; es el camino de respaldo cuando el bloque choca con
+    uq_cita_horario_gabinete (releer la ocupación no sirve: con REPEATABLE READ la
+    transacción volvería a ver la misma instantánea y elegiría los mismos gabinetes).
+    """
+    # Fechas objetivo: a partir de la semana siguiente a la original, máximo 12 semanas (3 meses)
+    fechas_objetivo = []
+    fecha_actual = fecha_inicio + timedelta(days=7)
     semana_numero = 1
-    
-    while fecha_actual <= fecha_fin and semana_numero <= 12:  # Máximo 12 semanas (3 meses)
-        
-        # Verificar disponibilidad antes de crear la cita
-        if verificar_disponibilidad_fecha(fecha_actual, hora):
-            id_gabinete = get_next_available_gabinete(fecha_actual, hora)
-            
-            if id_gabinete:
-                # Crear nueva cita para fechas futuras
-                cita = Cita(
-                    fecha=fecha_actual,
-                    hora=hora,
-                    id_paciente=id_paciente,
-                    id_motivo=3,  # Terapia visual
-                    id_gabinete=id_gabinete,
-                    estado='Programada',
-                    id_usuario=id_usuario
-                )
-                db.session.add(cita)
-                db.session.flush()
-                
-                # Registrar en el detalle de la serie recurrente
-                detalle = CitaRecurrenteDetalle(
-                    id_serie=id_serie,
-                    id_cita=cita.id_cita,
-                    fecha_programada=fecha_actual,
-                    estado_individual='Programada'
-                )
-                db.session.add(detalle)
-                
-                citas_generadas.append(cita)
-                print(f"  📅 Semana {semana_numero}: {fecha_actual} - Gabinete {id_gabinete}")
-        
-        # Avanzar a la siguiente semana (7 días exactos)
+    while fecha_actual <= fecha_fin and semana_numero <= 12:
+        fechas_objetivo.append((semana_numero, fecha_actual))
         fecha_actual += timedelta(days=7)
         semana_numero += 1
-    
-    print(f"📊 Total de citas recurrentes generadas: {len(citas_generadas)}")
+
+    if not fechas_objetivo:
+        return []
+
+    if por_semana:
+        citas_generadas = []
+        for _, fecha in fechas_objetivo:
+            cita = reservar_gabinete(fecha, hora, id_paciente=id_paciente, id_motivo=3,
+                                     estado='Programada', id_usuario=id_usuario)
+            if cita is not None:
+                citas_generadas.append(cita)
+    else:
+        citas_generadas = _insertar_citas_en_bloque(fechas_objetivo, id_paciente, hora, id_usuario)
+
+    if not citas_generadas:
+        logger.info('Total de citas recurrentes generadas: 0')
+        return []
+
+    db.session.execute(insert(CitaRecurrenteDetalle), [
+        {
+            'id_serie': id_serie,
+            'id_cita': cita.id_cita,
+            'fecha_programada': cita.fecha,
+            'estado_individual': 'Programada'
+        }
+        for cita in citas_generadas
+    ])
+
+    logger.info('Total de citas recurrentes generadas: %s', len(citas_generadas),
+                extra={'id_serie': id_serie})
     return citas_generadas
 
 def obtener_serie_de_cita(cita_id):
@@ -339,15 +1273,261 @@ def es_cita_recurrente(cita_id):
     """Verifica si una cita pertenece a una serie recurrente"""
     return CitaRecurrenteDetalle.query.filter_by(id_cita=cita_id).first() is not None
 
+def con_relaciones_cita(query):
+    """
+    Carga Paciente en la misma consulta de Cita (JOIN), para que serializar N citas cueste
+    1 consulta en lugar de 1 + N cargas perezosas. Motivo y gabinete salen de `catalogos`.
+    """
+    return query.options(joinedload(Cita.paciente))
+
+# ----------------------------------------------------
+# 📄 Paginación por cursor (keyset) de listados de citas
+# ----------------------------------------------------
+
+LIMITE_PAGINA_DEFECTO = 200
+LIMITE_PAGINA_MAXIMO = 1000
+PARAMETROS_LISTADO = ('desde', 'hasta', 'estado', 'gabinete', 'motivo', 'cursor', 'limite')
+
+def codificar_cursor(cita):
+    """Codifica la posición (fecha, hora, id_cita) de una cita como cursor opaco"""
+    posicion = [cita.fecha.strftime('%Y-%m-%d'), cita.hora.strftime('%H:%M:%S'), cita.id_cita]
+    return base64.urlsafe_b64encode(json.dumps(posicion).encode('utf-8')).decode('ascii')
+
+def decodificar_cursor(cursor):
+    """Decodifica un cursor opaco. Lanza ValueError si está mal formado"""
+    try:
+        fecha_str, hora_str, id_cita = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return (
+            datetime.strptime(fecha_str, '%Y-%m-%d').date(),
+            datetime.strptime(hora_str, '%H:%M:%S').time(),
+            int(id_cita)
+        )
+    except Exception:
+        raise ValueError('Cursor inválido')
+
+def leer_filtros_listado(args):
+    """
+    Lee los filtros de listado desde los parámetros de la URL.
+    Lanza ValueError con un mensaje para el cliente si algún valor es inválido.
+    """
+    filtros = {}
+    try:
+        if args.get('desde'):
+            filtros['desde'] = datetime.strptime(args['desde'], '%Y-%m-%d').date()
+        if args.get('hasta'):
+            filtros['hasta'] = datetime.strptime(args['hasta'], '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError('Formato de fecha inválido en desde/hasta. Use YYYY-MM-DD')
+
+    if args.get('estado'):
+        filtros['estados'] = [e.strip() for e in args['estado'].split(',') if e.strip()]
+
+    try:
+        if args.get('gabinete'):
+            filtros['gabinetes'] = [int(g) for g in args['gabinete'].split(',')]
+        if args.get('motivo'):
+            filtros['motivos'] = [int(m) for m in args['motivo'].split(',')]
+    except ValueError:
+        raise ValueError('Los filtros gabinete y motivo deben ser IDs numéricos')
+
+    if args.get('cursor'):
+        filtros['cursor'] = decodificar_cursor(args['cursor'])
+
+    try:
+        limite = int(args.get('limite', LIMITE_PAGINA_DEFECTO))
+    except ValueError:
+        raise ValueError('El límite debe ser numérico')
+    filtros['limite'] = max(1, min(limite, LIMITE_PAGINA_MAXIMO))
+    return filtros
+
+def aplicar_filtros_citas(query, filtros):
+    """Aplica la ventana de fechas y los filtros de estado/gabinete/motivo a una consulta de Cita"""
+    if 'desde' in filtros:
+        query = query.filter(Cita.fecha >= filtros['desde'])
+    if 'hasta' in filtros:
+        query = query.filter(Cita.fecha <= filtros['hasta'])
+    if filtros.get('estados'):
+        query = query.filter(Cita.estado.in_(filtros['estados']))
+    if filtros.get('gabinetes'):
+        query = query.filter(Cita.id_gabinete.in_(filtros['gabinetes']))
+    if filtros.get('motivos'):
+        query = query.filter(Cita.id_motivo.in_(filtros['motivos']))
+    return query
+
+def paginar_citas(query, filtros):
+    """
+    Devuelve una página de citas ordenada por (fecha, hora, id_cita) a partir del cursor.
+    Retorna (citas, siguiente_cursor); siguiente_cursor es None en la última página.
+    """
+    query = con_relaciones_cita(aplicar_filtros_citas(query, filtros))
+
+    if 'cursor' in filtros:
+        fecha_c, hora_c, id_c = filtros['cursor']
+        query = query.filter(or_(
+            Cita.fecha > fecha_c,
+            and_(Cita.fecha == fecha_c, Cita.hora > hora_c),
+            and_(Cita.fecha == fecha_c, Cita.hora == hora_c, Cita.id_cita > id_c)
+        ))
+
+    limite = filtros['limite']
+    # Se pide una fila extra para saber si existe una página siguiente sin hacer COUNT
+    citas = query.order_by(Cita.fecha, Cita.hora, Cita.id_cita).limit(limite + 1).all()
+
+    siguiente_cursor = None
+    if len(citas) > limite:
+        citas = citas[:limite]
+        siguiente_cursor = codificar_cursor(citas[-1])
+    return citas, siguiente_cursor
+
+TAMANO_LOTE_STREAM = 500
+
+def stream_json_citas(query):
+    """
+    Respuesta JSON (arreglo) generada por lotes desde un cursor del servidor:
+    la memoria no depende del total de filas y el primer byte sale enseguida.
+    """
+    def generar():
+        yield '['
+        primero = True
+        lote = []
+        try:
+            # Se ejecuta como select 2.0: Query aplicaría unique() por el joinedload,
+            # que es incompatible con yield_per
+            filas = db.session.execute(
+                query.statement.execution_options(yield_per=TAMANO_LOTE_STREAM)
+            ).scalars()
+            for cita in filas:
+                lote.append(app.json.dumps(cita.to_dict()))
+                if len(lote) >= TAMANO_LOTE_STREAM:
+                    yield ('' if primero else ',') + ','.join(lote)
+                    primero = False
+                    lote = []
+            if lote:
+                yield ('' if primero else ',') + ','.join(lote)
+        except Exception:
+            # El código de estado ya se envió: se aborta la conexión para que el cliente
+            # no tome un arreglo truncado por un listado completo
+            logger.exception('Error generando listado de citas')
+            raise
+        yield ']'
+
+    return Response(stream_with_context(generar()), mimetype='application/json')
+
+def responder_listado_citas(query):
+    """
+    Respuesta común de los listados de citas del panel.
+    Sin parámetros de listado se conserva la respuesta histórica (arreglo completo,
+    enviado en streaming); con cualquiera de ellos se devuelve una página con su cursor siguiente.
+    """
+    if not any(p in request.args for p in PARAMETROS_LISTADO):
+        return stream_json_citas(con_relaciones_cita(query).order_by(Cita.fecha, Cita.hora, Cita.id_cita))
+
+    try:
+        filtros = leer_filtros_listado(request.args)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    citas, siguiente_cursor = paginar_citas(query, filtros)
+    return jsonify({
+        'citas': [cita.to_dict() for cita in citas],
+        'siguiente_cursor': siguiente_cursor,
+        'total_pagina': len(citas)
+    }), 200
+
 
 # ----------------------------------------------------
 # 🔑 Flask-Login Configuration
 # ----------------------------------------------------
 
+# Identidades de usuarios autenticados en memoria: con la caché caliente, autenticar una
+# petición no cuesta ninguna consulta. Se invalidan al confirmar cambios de usuarios,
+# roles o permisos, y el TTL acota lo que puede durar un dato de otro proceso.
+
+USUARIOS_TTL_SEGUNDOS = 300
+USUARIOS_MAX_CACHE = 1000
+
+class UsuarioSesion(UserMixin):
+    """Identidad de solo lectura de `current_user` (no es una fila ORM de Usuario)"""
+
+    def __init__(self, id_usuario, nombre_usuario, id_rol, nombre_rol, permisos):
+        self.id_usuario = id_usuario
+        self.nombre_usuario = nombre_usuario
+        self.id_rol = id_rol
+        self.nombre_rol = nombre_rol
+        self.permisos = frozenset(permisos)
+
+    def get_id(self):
+        return str(self.id_usuario)
+
+_usuarios_sesion = {}
+_usuarios_lock = threading.Lock()
+
+def _cargar_usuario_sesion(id_usuario):
+    usuario = db.session.query(Usuario.nombre_usuario, Usuario.id_rol).filter_by(id_usuario=id_usuario).first()
+    if usuario is None:
+        return None
+    permisos = db.session.query(Permiso.nombre_permiso).join(
+        rol_permiso, rol_permiso.c.id_permiso == Permiso.id_permiso
+    ).filter(rol_permiso.c.id_rol == usuario.id_rol).union(
+        db.session.query(Permiso.nombre_permiso).join(
+            usuario_permiso, usuario_permiso.c.id_permiso == Permiso.id_permiso
+        ).filter(usuario_permiso.c.id_usuario == id_usuario)
+    ).all()
+    return UsuarioSesion(id_usuario, usuario.nombre_usuario, usuario.id_rol,
+                         catalogos.nombre_rol(usuario.id_rol), [nombre for (nombre,) in permisos])
+
+def obtener_usuario_sesion(id_usuario):
+    """Retorna la identidad del usuario desde memoria si es posible"""
+    ahora = reloj.monotonic()
+    with _usuarios_lock:
+        entrada = _usuarios_sesion.get(id_usuario)
+    if entrada and ahora - entrada[0] < USUARIOS_TTL_SEGUNDOS:
+        return entrada[1]
+
+    identidad = _cargar_usuario_sesion(id_usuario)
+    if identidad is not None:
+        with _usuarios_lock:
+            if len(_usuarios_sesion) >= USUARIOS_MAX_CACHE:
+                _usuarios_sesion.pop(next(iter(_usuarios_sesion)))  # la entrada más antigua
+            _usuarios_sesion[id_usuario] = (ahora, identidad)
+    return identidad
+
+def invalidar_usuarios(ids=None):
+    """Descarta las identidades indicadas, o todas si no se indican"""
+    with _usuarios_lock:
+        if ids is None:
+            _usuarios_sesion.clear()
+        else:
+            for id_usuario in ids:
+                _usuarios_sesion.pop(id_usuario, None)
+
+@event.listens_for(db.session, 'before_flush')
+def _detectar_cambios_usuarios(sesion, contexto, instancias):
+    for obj in list(sesion.new) + list(sesion.dirty) + list(sesion.deleted):
+        if isinstance(obj, (Rol, Permiso)):
+            # Un cambio de rol o permiso puede afectar a cualquier usuario
+            sesion.info['usuarios_modificados'] = None
+            return
+        if isinstance(obj, Usuario) and sesion.info.get('usuarios_modificados', set()) is not None:
+            sesion.info.setdefault('usuarios_modificados', set()).add(obj.id_usuario)
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidar_usuarios_confirmados(sesion):
+    if sesion.in_nested_transaction():
+        return
+    if 'usuarios_modificados' in sesion.info:
+        invalidar_usuarios(sesion.info.pop('usuarios_modificados'))
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_cambios_usuarios(sesion):
+    if sesion.in_nested_transaction():
+        return
+    sesion.info.pop('usuarios_modificados', None)
+
 @login_manager.user_loader
 def load_user(user_id):
     try:
-        return db.session.get(Usuario, int(user_id))
+        return obtener_usuario_sesion(int(user_id))
     except:
         return None
 
@@ -363,10 +1543,124 @@ def make_session_permanent():
 # ⚙️ Funciones de Inicialización
 # ----------------------------------------------------
 
+def _crear_indice_si_falta(modelo, nombre):
+    """Crea el índice declarado en el modelo si la base existente aún no lo tiene"""
+    inspector = inspect(db.engine)
+    tabla = modelo.__table__
+    existentes = {i['name'] for i in inspector.get_indexes(tabla.name)}
+    existentes |= {u['name'] for u in inspector.get_unique_constraints(tabla.name)}
+    if nombre in existentes:
+        return
+    indice = next(i for i in tabla.indexes if i.name == nombre)
+    indice.create(bind=db.engine)
+    print(f"  🧱 Índice {nombre} creado en {tabla.name}")
+
+def _migracion_indices_consultas():
+    _crear_indice_si_falta(Cita, 'ix_cita_fecha_hora')
+    _crear_indice_si_falta(CitaRecurrenteDetalle, 'ix_detalle_id_cita')
+    _crear_indice_si_falta(CitaRecurrenteDetalle, 'ix_detalle_id_serie')
+
+def _migracion_horario_unico():
+    duplicados = db.session.query(
+        Cita.fecha, Cita.hora, Cita.id_gabinete, func.count(Cita.id_cita)
+    ).group_by(Cita.fecha, Cita.hora, Cita.id_gabinete).having(func.count(Cita.id_cita) > 1).all()
+    if duplicados:
+        detalle = ', '.join(f"{f} {h} gabinete {g} ({n} citas)" for f, h, g, n in duplicados[:10])
+        raise RuntimeError(f"Hay gabinetes con más de una cita en el mismo horario: {detalle}")
+
+    inspector = inspect(db.engine)
+    existentes = {i['name'] for i in inspector.get_indexes('cita')}
+    existentes |= {u['name'] for u in inspector.get_unique_constraints('cita')}
+    if 'uq_cita_horario_gabinete' not in existentes:
+        # CREATE UNIQUE INDEX funciona igual en MySQL y SQLite (SQLite no admite ADD CONSTRAINT)
+        db.Index('uq_cita_horario_gabinete', Cita.fecha, Cita.hora, Cita.id_gabinete, unique=True).create(bind=db.engine)
+        print("  🧱 Restricción uq_cita_horario_gabinete creada en cita")
+
+def _migracion_version_cambio():
+    for modelo, indice in ((Cita, 'ix_cita_version_cambio'),
+                           (CitaRecurrenteDetalle, 'ix_detalle_version_cambio')):
+        tabla = modelo.__table__.name
+        columnas = {c['name'] for c in inspect(db.engine).get_columns(tabla)}
+        if 'version_cambio' not in columnas:
+            with db.engine.begin() as conexion:
+                conexion.exec_driver_sql(
+                    f"ALTER TABLE {tabla} ADD COLUMN version_cambio BIGINT NOT NULL DEFAULT 0"
+                )
+            print(f"  🧱 Columna version_cambio agregada a {tabla}")
+        _crear_indice_si_falta(modelo, indice)
+
+def _migracion_estadistica_diaria():
+    EstadisticaDiaria.__table__.create(bind=db.engine, checkfirst=True)
+    print(f"  📈 Estadística diaria calculada: {recalcular_estadisticas()} filas")
+
+# Lista ordenada de migraciones: (versión, descripción, función, versiones de las que depende).
+# Cada función debe ser idempotente, porque una base nueva creada con create_all ya tiene el
+# esquema actual. Una migración fallida solo detiene a las que dependen de ella.
+MIGRACIONES = [
+    (1, 'Índices de horario de cita y de detalle de series', _migracion_indices_consultas, ()),
+    (2, 'Restricción única de gabinete por fecha y hora', _migracion_horario_unico, ()),
+    (3, 'Versión de cambio en citas y detalles de series', _migracion_version_cambio, ()),
+    (4, 'Estadística diaria pre-agregada de citas', _migracion_estadistica_diaria, ()),
+]
+
+def aplicar_migraciones():
+    """
+    Aplica en orden las migraciones pendientes y registra cada versión aplicada.
+    Lanza RuntimeError al final si alguna no pudo aplicarse: el modelo ya espera el
+    esquema nuevo, así que la aplicación no debe arrancar sobre una base a medias.
+    """
+    VersionEsquema.__table__.create(bind=db.engine, checkfirst=True)
+    aplicadas = {v for (v,) in db.session.query(VersionEsquema.version).all()}
+    fallidas = {}
+
+    for version, descripcion, migracion, dependencias in MIGRACIONES:
+        if version in aplicadas:
+            continue
+        bloqueantes = [d for d in dependencias if d not in aplicadas]
+        if bloqueantes:
+            fallidas[version] = f"depende de la migración {', '.join(map(str, bloqueantes))}"
+            continue
+        print(f"🔧 Migración {version}: {descripcion}")
+        try:
+            migracion()
+        except RuntimeError as e:
+            db.session.rollback()
+            fallidas[version] = str(e)
+            print(f"❌ Migración {version} no aplicada: {e}")
+            continue
+        db.session.add(VersionEsquema(version=version, descripcion=descripcion))
+        db.session.commit()
+        aplicadas.add(version)
+
+    if fallidas:
+        detalle = '; '.join(f"{v}: {motivo}" for v, motivo in fallidas.items())
+        raise RuntimeError(f"Migraciones pendientes sin aplicar ({detalle})")
+    return max(aplicadas)
+
+@app.cli.command('migrar')
+def migrar_comando():
+    """Actualiza el esquema de una base existente (flask --app app migrar)."""
+    with app.app_context():
+        try:
+            version = aplicar_migraciones()
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+    print(f"✅ Esquema en la versión {version}")
+
+@app.cli.command('recalcular-estadisticas')
+def recalcular_estadisticas_comando():
+    """Reconstruye la tabla estadistica_diaria desde las citas existentes."""
+    with app.app_context():
+        filas = recalcular_estadisticas()
+    print(f"✅ Estadística diaria recalculada: {filas} filas")
+
 def inicializar_db():
     """Crea las tablas e inserta datos iniciales."""
     with app.app_context():
         db.create_all()
+        # Si alguna migración falla se detiene el arranque (RuntimeError): corrija los datos
+        # indicados y ejecute `flask --app app migrar`
+        aplicar_migraciones()
         
         # 1. Permisos
         permisos_data = ['lectura', 'edicion']
@@ -440,7 +1734,13 @@ def inicializar_db():
         except AttributeError:
             print("⚠️ Advertencia: Config.MOTIVOS_CITA no encontrado, saltando inicialización de motivos.")
 
+        # 6. Contador de versión de la agenda
+        if not db.session.get(VersionAgenda, 1):
+            db.session.add(VersionAgenda(id=1, version=0))
+
         db.session.commit()
+        # 7. Catálogos de referencia en memoria
+        catalogos.cargar()
         print("✅ Base de datos inicializada con datos por defecto.")
 
 
@@ -469,12 +1769,12 @@ def login():
         login_user(user, remember=True, duration=timedelta(hours=1))
         session.modified = True
         
-        print(f"✅ LOGIN EXITOSO: {username}")
+        logger.info('Login exitoso: %s', username, extra={'id_usuario': user.id_usuario})
         
         response = jsonify({
             'message': 'Login exitoso', 
             'user': user.nombre_usuario, 
-            'rol': user.rol.nombre_rol,
+            'rol': catalogos.nombre_rol(user.id_rol),
             'id_usuario': user.id_usuario,
             'session_created': True
         })
@@ -485,6 +1785,7 @@ def login():
 @app.route('/logout')
 @login_required
 def logout():
+    invalidar_usuarios([current_user.id_usuario])
     logout_user()
     session.clear()
     return jsonify({'message': 'Logout exitoso'}), 200
@@ -499,7 +1800,7 @@ def get_current_user():
     return jsonify({
         'id_usuario': current_user.id_usuario,
         'nombre_usuario': current_user.nombre_usuario,
-        'rol': current_user.rol.nombre_rol,
+        'rol': current_user.nombre_rol,
         'session_active': True
     }), 200
 
@@ -557,39 +1858,232 @@ def agendar_cita():
         if not paciente:
             return jsonify({'message': 'Paciente habitual no encontrado con este teléfono.'}), 404
 
-    # 2. Buscar un gabinete disponible para ESA hora específica
-    id_gabinete = get_next_available_gabinete(fecha_dt, hora_dt)
-
-    # 3. Si la función devolvió None, significa que los 6 gabinetes están llenos
-    if id_gabinete is None:
-         return jsonify({'message': 'Todos los gabinetes están ocupados para este horario.'}), 409
-    
-    gabinete = Gabinete.query.get(id_gabinete)
-
-    # 4. Creación de la cita
+    # 2-4. Reservar el primer gabinete libre para ESA hora (reintenta si otra petición lo gana)
     try:
-        nueva_cita = Cita(
-            fecha=fecha_dt,
-            hora=hora_dt,
+        nueva_cita = reservar_gabinete(
+            fecha_dt,
+            hora_dt,
             id_paciente=paciente.id_paciente,
             id_motivo=data['id_motivo'],
-            id_gabinete=id_gabinete,
             estado='Programada'
         )
-        db.session.add(nueva_cita)
+
+        # Si no se pudo reservar, significa que los 6 gabinetes están llenos
+        if nueva_cita is None:
+            db.session.rollback()
+            registrar_reserva('agendar', 'lleno')
+            return jsonify({'message': 'Todos los gabinetes están ocupados para este horario.'}), 409
+
+        nombre_gabinete = catalogos.nombre_gabinete(nueva_cita.id_gabinete)
         db.session.commit()
         
-        print(f"✅ Cita agendada: {paciente.nombre} el {data['fecha']} a las {data['hora']} en {gabinete.nombre}")
+        cita_dict = nueva_cita.to_dict()
+        logger.info('Cita agendada: %s el %s a las %s en %s', paciente.nombre, data['fecha'], data['hora'],
+                    nombre_gabinete, extra={'id_cita': cita_dict['id_cita']})
+        publicar_evento_agenda('cita_agendada', {'cita': cita_dict})
+        registrar_reserva('agendar', 'exito')
         
         return jsonify({
             'message': 'Cita agendada con éxito',
-            'cita': nueva_cita.to_dict()
+            'cita': cita_dict
         }), 201
     
     except Exception as e:
         db.session.rollback()
+        registrar_reserva('agendar', 'error')
+        logger.exception('Error al agendar cita')
         return jsonify({'message': 'Error interno al agendar la cita', 'error': str(e)}), 500
 
+# ----------------------------------------------------
+# 👨‍👩‍👧 Agendado en lote (familias, grupos de escuelas)
+# ----------------------------------------------------
+
+LOTE_MAX_CITAS = 100
+
+def _validar_item_lote(item):
+    """Retorna (fecha, hora) o un mensaje de error para un elemento del lote"""
+    if not isinstance(item, dict):
+        return 'El elemento debe ser un objeto'
+    for field in ['fecha', 'hora', 'id_motivo', 'es_nuevo', 'nombre', 'apellido', 'edad', 'telefono']:
+        if field not in item:
+            return f'Falta el campo requerido: {field}'
+    # Se comprueban los tipos antes de usarlos como claves (una lista no es hashable)
+    if not isinstance(item['id_motivo'], int) or isinstance(item['id_motivo'], bool) \
+            or item['id_motivo'] not in catalogos.motivos:
+        return 'Motivo de cita inválido'
+    if not isinstance(item['telefono'], str) or not item['telefono'] or len(item['telefono']) > 15:
+        return 'Teléfono inválido'
+    # Mismos límites que las columnas de Paciente: un elemento mal formado no debe tumbar el INSERT del lote
+    for field in ['nombre', 'apellido']:
+        if not isinstance(item[field], str) or not item[field].strip() or len(item[field]) > 50:
+            return f'El campo {field} debe ser un texto de 1 a 50 caracteres'
+    if not isinstance(item['edad'], int) or isinstance(item['edad'], bool):
+        return 'La edad debe ser un número entero'
+    try:
+        return (datetime.strptime(item['fecha'], '%Y-%m-%d').date(),
+                datetime.strptime(item['hora'], '%H:%M:%S').time())
+    except (TypeError, ValueError):
+        return 'Formato de fecha u hora inválido'
+
+def _insertar_citas_lote(filas):
+    """
+    Inserta en bloque las citas ya asignadas y las retorna (con paciente cargado) en el
+    orden de `filas`. Las citas en bloque no pasan por before_flush, así que se registran
+    aquí en el índice de ocupación, la versión de la agenda y la estadística diaria.
+    """
+    db.session.execute(insert(Cita), filas)
+    db.session.info.setdefault('slots_ocupacion', set()).update((f['fecha'], f['hora']) for f in filas)
+
+    por_horario = {
+        (cita.fecha, cita.hora, cita.id_gabinete): cita
+        for cita in con_relaciones_cita(Cita.query).filter(
+            Cita.fecha.in_({f['fecha'] for f in filas}),
+            Cita.hora.in_({f['hora'] for f in filas}),
+            Cita.id_paciente.in_({f['id_paciente'] for f in filas})
+        )
+    }
+    citas = [por_horario[(f['fecha'], f['hora'], f['id_gabinete'])] for f in filas]
+
+    registrar_cambios_agenda(db.session, citas)
+    for f in filas:
+        acumular_estadistica(db.session, _clave_estadistica(f['fecha'], f['id_gabinete'], f['id_motivo'], 'Programada'), 1)
+    return citas
+
+@app.route('/api/citas/agendar_lote', methods=['POST'])
+@login_required
+def agendar_lote():
+    """
+    Agenda varias citas en una sola transacción. Los pacientes se buscan y crean en bloque,
+    la ocupación de todos los horarios se lee en una consulta y los gabinetes se asignan
+    en memoria. Cada elemento recibe su propio resultado: agendada, lleno o rechazada.
+    """
+    data = request.get_json() or {}
+    items = data.get('citas')
+    if not isinstance(items, list) or not items:
+        return jsonify({'message': 'Se requiere una lista "citas" con al menos un elemento'}), 400
+    if len(items) > LOTE_MAX_CITAS:
+        return jsonify({'message': f'El lote admite como máximo {LOTE_MAX_CITAS} citas'}), 400
+
+    resultados = [None] * len(items)
+    horarios = {}
+    for indice, item in enumerate(items):
+        validacion = _validar_item_lote(item)
+        if isinstance(validacion, str):
+            resultados[indice] = {'indice': indice, 'resultado': 'rechazada', 'message': validacion}
+        else:
+            horarios[indice] = validacion
+
+    try:
+        # 1. Pacientes existentes en una consulta; los nuevos se insertan en bloque solo si
+        #    su cita obtiene gabinete (como en agendar_cita, un horario lleno no crea paciente)
+        telefonos = {items[i]['telefono'] for i in horarios}
+        pacientes = {p.telefono: p.id_paciente for p in
+                     db.session.query(Paciente.telefono, Paciente.id_paciente).filter(Paciente.telefono.in_(telefonos))}
+        telefonos_nuevos = set()
+        for indice in list(horarios):
+            item = items[indice]
+            mensaje = None
+            if item['es_nuevo'] and (item['telefono'] in pacientes or item['telefono'] in telefonos_nuevos):
+                mensaje = 'Ya existe un paciente con este número de teléfono'
+            elif not item['es_nuevo'] and item['telefono'] not in pacientes:
+                mensaje = 'Paciente habitual no encontrado con este teléfono'
+            elif item['es_nuevo']:
+                telefonos_nuevos.add(item['telefono'])
+            if mensaje:
+                resultados[indice] = {'indice': indice, 'resultado': 'rechazada', 'message': mensaje}
+                del horarios[indice]
+
+        # 2. Ocupación de todos los horarios del lote en una sola consulta
+        ocupacion = {}
+        if horarios:
+            for fecha, hora, id_gabinete in db.session.query(Cita.fecha, Cita.hora, Cita.id_gabinete).filter(
+                Cita.fecha.in_({f for f, _ in horarios.values()}),
+                Cita.hora.in_({h for _, h in horarios.values()})
+            ):
+                ocupacion.setdefault((fecha, hora), set()).add(id_gabinete)
+
+        # 3. Asignación de gabinetes en memoria, en el orden del lote
+        todos_gabinetes = [g['id'] for g in Config.GABINETES]
+        filas, indices_filas = [], []
+        for indice, (fecha, hora) in horarios.items():
+            ocupados = ocupacion.setdefault((fecha, hora), set())
+            id_gabinete = next((g_id for g_id in todos_gabinetes if g_id not in ocupados), None)
+            if id_gabinete is None:
+                resultados[indice] = {'indice': indice, 'resultado': 'lleno',
+                                      'message': 'Todos los gabinetes están ocupados para este horario.'}
+                continue
+            ocupados.add(id_gabinete)
+            filas.append({'fecha': fecha, 'hora': hora, 'id_gabinete': id_gabinete,
+                          'id_motivo': items[indice]['id_motivo'], 'estado': 'Programada',
+                          'id_usuario': current_user.id_usuario})
+            indices_filas.append(indice)
+
+        nuevos = {
+            items[i]['telefono']: {'nombre': items[i]['nombre'], 'apellido': items[i]['apellido'],
+                                   'edad': items[i]['edad'], 'telefono': items[i]['telefono']}
+            for i in indices_filas if items[i]['es_nuevo']
+        }
+        if nuevos:
+            db.session.execute(insert(Paciente), list(nuevos.values()))
+            pacientes.update(db.session.query(Paciente.telefono, Paciente.id_paciente).filter(
+                Paciente.telefono.in_(nuevos)).all())
+        for indice, fila in zip(indices_filas, filas):
+            fila['id_paciente'] = pacientes[items[indice]['telefono']]
+
+        # 4. INSERT en bloque; si otra petición ganó algún gabinete entre la lectura y la
+        #    escritura, se revierte el SAVEPOINT y esas citas se reservan una por una
+        citas = []
+        if filas:
+            try:
+                with db.session.begin_nested():
+                    citas = _insertar_citas_lote(filas)
+            except IntegrityError:
+                invalidar_ocupacion({(f['fecha'], f['hora']) for f in filas})
+                citas = [
+                    reservar_gabinete(f['fecha'], f['hora'], id_paciente=f['id_paciente'],
+                                      id_motivo=f['id_motivo'], estado='Programada', id_usuario=f['id_usuario'])
+                    for f in filas
+                ]
+                # Los pacientes nuevos cuya cita se quedó sin gabinete no deben persistir
+                sin_gabinete = [items[i]['telefono'] for i, cita in zip(indices_filas, citas)
+                                if cita is None and items[i]['es_nuevo']]
+                if sin_gabinete:
+                    Paciente.query.filter(Paciente.telefono.in_(sin_gabinete)).delete(synchronize_session=False)
+
+        # Se serializa antes del commit para no recargar cada cita expirada
+        citas_dict = []
+        for indice, cita in zip(indices_filas, citas):
+            if cita is None:
+                resultados[indice] = {'indice': indice, 'resultado': 'lleno',
+                                      'message': 'Todos los gabinetes están ocupados para este horario.'}
+                continue
+            cita_dict = cita.to_dict()
+            citas_dict.append(cita_dict)
+            resultados[indice] = {'indice': indice, 'resultado': 'agendada', 'cita': cita_dict}
+
+        db.session.commit()
+
+    except Exception:
+        db.session.rollback()
+        registrar_reserva('agendar_lote', 'error')
+        logger.exception('Error al agendar lote de citas')
+        return jsonify({'message': 'Error interno al agendar el lote'}), 500
+
+    for resultado in resultados:
+        registrar_reserva('agendar_lote', {'agendada': 'exito'}.get(resultado['resultado'], resultado['resultado']))
+    if citas_dict:
+        publicar_evento_agenda('lote_agendado', {'citas': citas_dict})
+    logger.info('Lote agendado: %s de %s citas', len(citas_dict), len(items))
+
+    agendadas = len(citas_dict)
+    codigo = 201 if agendadas else (409 if any(r['resultado'] == 'lleno' for r in resultados) else 400)
+    return jsonify({
+        'message': f'{agendadas} de {len(items)} citas agendadas',
+        'agendadas': agendadas,
+        'rechazadas': len(items) - agendadas,
+        'resultados': resultados
+    }), codigo
+
 # Ruta para buscar disponibilidad (Paso 3)
 @app.route('/api/citas/disponibilidad', methods=['POST'])
 def get_disponibilidad():
@@ -611,9 +2105,15 @@ def get_disponibilidad():
     disponibilidad = {}
     horarios_atencion = Config.HORARIOS_ATENCION
 
+    # Citas por hora del día en una sola consulta (antes un COUNT por cada horario)
+    citas_por_hora = {
+        str(hora): total for hora, total in
+        db.session.query(Cita.hora, func.count(Cita.id_cita)).filter(Cita.fecha == fecha_dt).group_by(Cita.hora).all()
+    }
+
     for hora in horarios_atencion:
         # Verifica si aún hay gabinetes libres para esa hora
-        citas_en_hora = Cita.query.filter_by(fecha=fecha_dt, hora=datetime.strptime(hora, '%H:%M:%S').time()).count()
+        citas_en_hora = citas_por_hora.get(hora, 0)
 
         if citas_en_hora < len(Config.GABINETES): 
             disponibilidad[hora] = 'Disponible'
@@ -623,6 +2123,53 @@ def get_disponibilidad():
     return jsonify({'disponibilidad': disponibilidad}), 200
 
 
+# Ruta para la disponibilidad de un mes completo (calendario)
+@app.route('/api/citas/disponibilidad/rango', methods=['POST'])
+def get_disponibilidad_rango():
+    """
+    Devuelve los gabinetes libres por día y hora para todo un mes ('mes': 'YYYY-MM'),
+    calculados con una sola consulta GROUP BY fecha, hora.
+    """
+    data = request.get_json() or {}
+    mes_str = data.get('mes')
+
+    if not mes_str:
+        return jsonify({'message': 'Mes requerido'}), 400
+
+    try:
+        primer_dia = datetime.strptime(mes_str, '%Y-%m').date()
+    except (TypeError, ValueError):
+        # Solo se admite un mes: un rango mayor o un valor que no sea texto también es inválido
+        return jsonify({'message': 'Formato de mes inválido. Use YYYY-MM'}), 400
+
+    ultimo_dia = primer_dia + relativedelta(months=1) - timedelta(days=1)
+    total_gabinetes = len(Config.GABINETES)
+
+    ocupacion = db.session.query(
+        Cita.fecha, Cita.hora, func.count(Cita.id_cita)
+    ).filter(
+        Cita.fecha.between(primer_dia, ultimo_dia)
+    ).group_by(Cita.fecha, Cita.hora).all()
+
+    ocupadas = {(fecha, str(hora)): total for fecha, hora, total in ocupacion}
+
+    disponibilidad = {}
+    dia = primer_dia
+    while dia <= ultimo_dia:
+        libres_por_hora = {}
+        if dia.weekday() < 5:
+            for hora in Config.HORARIOS_ATENCION:
+                libres_por_hora[hora] = max(0, total_gabinetes - ocupadas.get((dia, hora), 0))
+        disponibilidad[dia.strftime('%Y-%m-%d')] = libres_por_hora
+        dia += timedelta(days=1)
+
+    return jsonify({
+        'mes': mes_str,
+        'total_gabinetes': total_gabinetes,
+        'disponibilidad': disponibilidad
+    }), 200
+
+
 # Ruta para buscar paciente habitual (Paso 4)
 @app.route('/api/paciente/buscar', methods=['POST'])
 def buscar_paciente():
@@ -646,20 +2193,182 @@ def buscar_paciente():
         }), 200
 
 
+# ----------------------------------------------------
+# 📥 Importación masiva de pacientes (CSV en streaming, upsert por teléfono)
+# ----------------------------------------------------
+
+IMPORTACION_TAMANO_LOTE = 1000
+IMPORTACION_MAX_RECHAZOS = 1000  # Rechazos detallados en el reporte (el conteo es completo)
+COLUMNAS_IMPORTACION = ('nombre', 'apellido', 'edad', 'telefono')
+
+def _validar_fila_paciente(fila):
+    """Retorna el dict listo para insertar o un mensaje de error"""
+    if any(fila.get(columna) is None for columna in COLUMNAS_IMPORTACION):
+        return 'Fila incompleta'
+    nombre, apellido = fila['nombre'].strip(), fila['apellido'].strip()
+    telefono = fila['telefono'].strip()
+    if not nombre or len(nombre) > 50:
+        return 'Nombre vacío o de más de 50 caracteres'
+    if len(apellido) > 50:
+        return 'Apellido de más de 50 caracteres'
+    if not telefono or len(telefono) > 15:
+        return 'Teléfono vacío o de más de 15 caracteres'
+    try:
+        edad = int(fila['edad'].strip())
+    except ValueError:
+        return 'Edad no numérica'
+    if not 0 <= edad <= 130:
+        return 'Edad fuera de rango'
+    return {'nombre': nombre, 'apellido': apellido, 'edad': edad, 'telefono': telefono}
+
+def _upsert_pacientes(filas):
+    """
+    Inserta o actualiza un lote de pacientes (sin teléfonos repetidos) con una sola sentencia
+    multi-fila. Retorna cuántos ya existían, leídos en una consulta previa del lote.
+    """
+    tabla = Paciente.__table__
+    existentes = {t for (t,) in db.session.query(Paciente.telefono).filter(
+        Paciente.telefono.in_([f['telefono'] for f in filas]))}
+    dialecto = db.session.get_bind().dialect.name
+    if dialecto == 'mysql':
+        sentencia = mysql_insert(tabla).values(filas)
+        db.session.execute(sentencia.on_duplicate_key_update(
+            nombre=sentencia.inserted.nombre, apellido=sentencia.inserted.apellido, edad=sentencia.inserted.edad
+        ))
+    elif dialecto == 'sqlite':
+        sentencia = sqlite_insert(tabla).values(filas)
+        db.session.execute(sentencia.on_conflict_do_update(
+            index_elements=[tabla.c.telefono],
+            set_={'nombre': sentencia.excluded.nombre, 'apellido': sentencia.excluded.apellido,
+                  'edad': sentencia.excluded.edad}
+        ))
+    else:
+        nuevas = [f for f in filas if f['telefono'] not in existentes]
+        if nuevas:
+            db.session.execute(tabla.insert(), nuevas)
+        for fila in filas:
+            if fila['telefono'] in existentes:
+                db.session.execute(tabla.update().where(tabla.c.telefono == fila['telefono']).values(fila))
+    return len(existentes)
+
+def importar_pacientes(archivo_texto):
+    """
+    Lee un CSV (nombre, apellido, edad, telefono) fila por fila desde un archivo de texto,
+    valida cada fila y hace upsert por teléfono en lotes de IMPORTACION_TAMANO_LOTE con un
+    commit por lote, sin cargar el archivo en memoria. Un teléfono repetido dentro del
+    mismo lote conserva la última fila y cuenta como actualización, igual que si la fila
+    anterior ya estuviera guardada: procesadas = insertadas + actualizadas + rechazadas.
+    Si la importación se corta, la excepción lleva en `reporte` lo ya confirmado y la
+    sección 'interrumpida' (más sus filas_no_guardadas en la suma anterior).
+    """
+    reporte = {'procesadas': 0, 'insertadas': 0, 'actualizadas': 0, 'rechazadas': 0, 'rechazos': []}
+    lector = csv.DictReader(archivo_texto)
+    faltantes = [c for c in COLUMNAS_IMPORTACION if c not in (lector.fieldnames or [])]
+    if faltantes:
+        raise ValueError(f"Faltan columnas en el CSV: {', '.join(faltantes)}")
+
+    def guardar(lote, repetidas):
+        existentes = _upsert_pacientes(list(lote.values()))
+        if existentes:
+            # Los listados de la agenda incluyen los datos del paciente: invalida sus ETag
+            registrar_cambios_agenda(db.session)
+        db.session.commit()
+        reporte['insertadas'] += len(lote) - existentes
+        reporte['actualizadas'] += existentes + repetidas
+
+    lote, repetidas, primera_linea = {}, 0, None
+    try:
+        for fila in lector:
+            reporte['procesadas'] += 1
+            paciente = _validar_fila_paciente(fila)
+            if isinstance(paciente, str):
+                reporte['rechazadas'] += 1
+                if len(reporte['rechazos']) < IMPORTACION_MAX_RECHAZOS:
+                    reporte['rechazos'].append({'linea': lector.line_num, 'motivo': paciente})
+                continue
+            if paciente['telefono'] in lote:
+                repetidas += 1
+            lote[paciente['telefono']] = paciente
+            primera_linea = primera_linea or lector.line_num
+            if len(lote) >= IMPORTACION_TAMANO_LOTE:
+                guardar(lote, repetidas)
+                lote, repetidas, primera_linea = {}, 0, None
+        if lote:
+            guardar(lote, repetidas)
+    except Exception as e:
+        # Los lotes anteriores ya están confirmados: el reporte parcial viaja con la excepción
+        # para que quien llama sepa qué se guardó y desde qué línea reanudar
+        db.session.rollback()
+        reporte['interrumpida'] = {
+            'ultima_linea_leida': lector.line_num,
+            'reanudar_desde_linea': primera_linea or lector.line_num,
+            'filas_no_guardadas': len(lote) + repetidas
+        }
+        e.reporte = reporte
+        raise
+
+    logger.info('Importación de pacientes: %s insertados, %s actualizados, %s rechazados',
+                reporte['insertadas'], reporte['actualizadas'], reporte['rechazadas'])
+    return reporte
+
+@app.route('/api/pacientes/importar', methods=['POST'])
+@login_required
+def importar_pacientes_api():
+    """Acepta el CSV como archivo multipart ('archivo') o como cuerpo text/csv"""
+    if 'archivo' in request.files:
+        flujo = request.files['archivo'].stream
+    elif request.mimetype == 'text/csv':
+        flujo = request.stream
+    else:
+        return jsonify({'message': 'Envíe el CSV en el campo "archivo" o con Content-Type text/csv'}), 400
+
+    try:
+        reporte = importar_pacientes(io.TextIOWrapper(flujo, encoding='utf-8-sig', newline=''))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        db.session.rollback()
+        return jsonify(dict(getattr(e, 'reporte', {}), message=f'CSV inválido: {e}')), 400
+    except Exception as e:
+        db.session.rollback()
+        logger.exception('Error al importar pacientes')
+        return jsonify(dict(getattr(e, 'reporte', {}), message='Error interno al importar pacientes',
+                            error=str(e))), 500
+    return jsonify(reporte), 200
+
+@app.cli.command('importar-pacientes')
+@click.argument('archivo', type=click.Path(exists=True, dir_okay=False))
+def importar_pacientes_comando(archivo):
+    """Importa pacientes desde un CSV (flask --app app importar-pacientes pacientes.csv)."""
+    with app.app_context(), open(archivo, encoding='utf-8-sig', newline='') as archivo_texto:
+        try:
+            reporte = importar_pacientes(archivo_texto)
+        except Exception as e:
+            reporte = getattr(e, 'reporte', None)
+            if reporte is None:
+                raise
+            interrumpida = reporte['interrumpida']
+            raise click.ClickException(
+                f"Importación interrumpida tras la línea {interrumpida['ultima_linea_leida']}: {e}. "
+                f"Ya guardados: {reporte['insertadas']} insertados, {reporte['actualizadas']} actualizados; "
+                f"reanudar desde la línea {interrumpida['reanudar_desde_linea']}"
+            )
+    print(f"✅ Pacientes: {reporte['insertadas']} insertados, {reporte['actualizadas']} actualizados, "
+          f"{reporte['rechazadas']} rechazados de {reporte['procesadas']}")
+    for rechazo in reporte['rechazos']:
+        print(f"  ⚠️ Línea {rechazo['linea']}: {rechazo['motivo']}")
+
 @app.route('/api/citas/admin', methods=['GET'])
 @login_required
+@con_etag_agenda
 def get_citas_admin():
     try:
-        citas = Cita.query.order_by(Cita.fecha, Cita.hora).all()
-        return jsonify([cita.to_dict() for cita in citas]), 200
+        return responder_listado_citas(Cita.query)
     except Exception as e:
         return jsonify({'message': 'Error al cargar citas', 'error': str(e)}), 500
 
 @app.route('/api/citas/debug', methods=['GET'])
 def debug_citas():
     try:
-        citas = Cita.query.all()
-        return jsonify([cita.to_dict() for cita in citas]), 200
+        return stream_json_citas(con_relaciones_cita(Cita.query).order_by(Cita.id_cita))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -695,12 +2404,19 @@ def editar_cita_completa(cita_id):
         
         if 'estado' in data:
             cita.estado = data['estado']
+
+        if ('fecha' in data or 'hora' in data) and not reubicar_gabinete_si_ocupado(cita):
+            db.session.rollback()
+            return jsonify({'message': 'Todos los gabinetes están ocupados para el nuevo horario.'}), 409
         
         db.session.commit()
+
+        cita_dict = cita.to_dict()
+        publicar_evento_agenda('cita_modificada', {'cita': cita_dict})
         
         response_data = {
             'message': 'Cita actualizada correctamente', 
-            'cita': cita.to_dict(),
+            'cita': cita_dict,
             'auditoria': {
                 'editor': data.get('matricula_editor'),
                 'tipo_modificacion': data.get('tipo_modificacion'),
@@ -717,25 +2433,197 @@ def editar_cita_completa(cita_id):
             'details': 'Verifique los datos e intente nuevamente'
         }), 500
 
+# ----------------------------------------------------
+# 🖼️ Activos estáticos con huella y precomprimidos
+# ----------------------------------------------------
+# Al arrancar (o en la primera petición) se calcula el hash del contenido de cada activo, se comprime una sola vez
+# (gzip y, si está instalado, brotli) y las páginas HTML se reescriben para apuntar a
+# /activos/<nombre>.<hash>.<ext>. Como la URL cambia con el contenido, el navegador
+# puede guardarlos un año sin revalidar; las páginas HTML se revalidan con ETag.
+
+ACTIVOS_ESTATICOS = ('funAdmin.js', 'principal.js', 'estiloAdmin.css', 'styles.css')
+PAGINAS_HTML = ('login.html', 'panelAdmin.html', 'vistaprincipal.html')
+CACHE_ACTIVOS = 'public, max-age=31536000, immutable'
+CODIFICACIONES_DISPONIBLES = ('br', 'gzip') if brotli else ('gzip',)
+
+_activos = None
+_activos_lock = threading.Lock()
+
+def comprimir(contenido, codificacion, nivel=None):
+    if codificacion == 'br':
+        return brotli.compress(contenido, quality=11 if nivel is None else nivel)
+    return gzip.compress(contenido, compresslevel=9 if nivel is None else nivel, mtime=0)
+
+def elegir_codificacion(disponibles):
+    """La mejor codificación de `disponibles` aceptada por el cliente (Accept-Encoding), o None"""
+    return request.accept_encodings.best_match(disponibles)
+
+def _variantes(contenido):
+    variantes = {'identity': contenido}
+    for codificacion in CODIFICACIONES_DISPONIBLES:
+        comprimido = comprimir(contenido, codificacion)
+        if len(comprimido) < len(contenido):
+            variantes[codificacion] = comprimido
+    return variantes
+
+def _marcas_de_tiempo():
+    return {
+        nombre: os.path.getmtime(os.path.join(app.root_path, nombre))
+        for nombre in ACTIVOS_ESTATICOS + PAGINAS_HTML
+    }
+
+def cargar_activos():
+    """Lee activos y páginas del disco, calcula huellas y variantes comprimidas"""
+    por_huella, rutas = {}, {}
+    for nombre in ACTIVOS_ESTATICOS:
+        with open(os.path.join(app.root_path, nombre), 'rb') as archivo:
+            contenido = archivo.read()
+        huella = hashlib.sha256(contenido).hexdigest()[:12]
+        base, extension = os.path.splitext(nombre)
+        nombre_huella = f'{base}.{huella}{extension}'
+        por_huella[nombre_huella] = {
+            'huella': huella,
+            'tipo': mimetypes.guess_type(nombre)[0] or 'application/octet-stream',
+            'variantes': _variantes(contenido)
+        }
+        rutas[nombre] = f'/activos/{nombre_huella}'
+
+    referencia = re.compile(r'(href|src)="(' + '|'.join(re.escape(n) for n in ACTIVOS_ESTATICOS) + r')"')
+    paginas = {}
+    for nombre in PAGINAS_HTML:
+        with open(os.path.join(app.root_path, nombre), 'r', encoding='utf-8') as archivo:
+            html = referencia.sub(lambda m: f'{m.group(1)}="{rutas[m.group(2)]}"', archivo.read())
+        contenido = html.encode('utf-8')
+        paginas[nombre] = {
+            'huella': hashlib.sha256(contenido).hexdigest()[:12],
+            'tipo': 'text/html',
+            'variantes': _variantes(contenido)
+        }
+
+    return {'por_huella': por_huella, 'paginas': paginas, 'rutas': rutas, 'marcas': _marcas_de_tiempo()}
+
+def obtener_activos():
+    """Manifiesto de activos; en modo debug se regenera si algún archivo cambió en disco"""
+    global _activos
+    with _activos_lock:
+        if _activos is None or (app.debug and _activos['marcas'] != _marcas_de_tiempo()):
+            _activos = cargar_activos()
+        return _activos
+
+def responder_activo(activo, cache_control):
+    """Envía la variante precomprimida que acepta el cliente, con ETag por codificación"""
+    codificacion = elegir_codificacion([c for c in activo['variantes'] if c != 'identity']) or 'identity'
+    response = Response(activo['variantes'][codificacion], mimetype=activo['tipo'])
+    if codificacion != 'identity':
+        response.headers['Content-Encoding'] = codificacion
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    response.set_etag(f"{activo['huella']}-{codificacion}")
+    return response.make_conditional(request)
+
+class InterfazSesionActivos(SecureCookieSessionInterface):
+    """No guarda la sesión en respuestas de activos: sin Set-Cookie ni Vary: Cookie en algo público"""
+
+    def save_session(self, app, session, response):
+        if request.endpoint == 'servir_activo':
+            return
+        return super().save_session(app, session, response)
+
+app.session_interface = InterfazSesionActivos()
+
+@app.route('/activos/<path:nombre>')
+def servir_activo(nombre):
+    activo = obtener_activos()['por_huella'].get(nombre)
+    if activo is None:
+        return jsonify({'message': 'Recurso no encontrado'}), 404
+    return responder_activo(activo, CACHE_ACTIVOS)
+
+def servir_pagina(nombre):
+    return responder_activo(obtener_activos()['paginas'][nombre], 'no-cache')
+
+# ----------------------------------------------------
+# 🗜️ Compresión negociada de respuestas de la API
+# ----------------------------------------------------
+
+COMPRESION_MIN_BYTES = int(os.environ.get('COMPRESION_MIN_BYTES', 1024))
+COMPRESION_NIVELES = {
+    'gzip': int(os.environ.get('COMPRESION_NIVEL_GZIP', 6)),
+    'br': int(os.environ.get('COMPRESION_NIVEL_BR', 5))
+}
+TIPOS_COMPRIMIBLES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain')
+
+def _compresor(codificacion):
+    """Compresor incremental: (comprimir(bloque), terminar()) para respuestas en streaming"""
+    if codificacion == 'br':
+        compresor = brotli.Compressor(quality=COMPRESION_NIVELES['br'])
+        # flush() entrega lo acumulado para que cada bloque del stream llegue sin esperar al final
+        return (lambda bloque: compresor.process(bloque) + compresor.flush()), compresor.finish
+    compresor = zlib.compressobj(COMPRESION_NIVELES['gzip'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (lambda bloque: compresor.compress(bloque) + compresor.flush(zlib.Z_SYNC_FLUSH)), compresor.flush
+
+def _comprimir_stream(iterable, codificacion):
+    comprimir_bloque, terminar = _compresor(codificacion)
+    try:
+        for bloque in iterable:
+            if isinstance(bloque, str):
+                bloque = bloque.encode('utf-8')
+            if bloque:
+                yield comprimir_bloque(bloque)
+        yield terminar()
+    finally:
+        # Cierra el generador original (p. ej. stream_with_context libera su contexto)
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+@app.after_request
+def comprimir_respuesta_api(response):
+    if (not request.path.startswith('/api/')
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in TIPOS_COMPRIMIBLES
+            or response.direct_passthrough):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    codificacion = elegir_codificacion(list(CODIFICACIONES_DISPONIBLES))
+    if codificacion is None:
+        return response
+
+    if response.is_streamed:
+        # El tamaño no se conoce de antemano: los streams se comprimen siempre
+        response.response = _comprimir_stream(response.response, codificacion)
+        response.headers.pop('Content-Length', None)
+    else:
+        cuerpo = response.get_data()
+        if len(cuerpo) < COMPRESION_MIN_BYTES:
+            return response
+        response.set_data(comprimir(cuerpo, codificacion, COMPRESION_NIVELES[codificacion]))
+
+    response.headers['Content-Encoding'] = codificacion
+    etiqueta, debil = response.get_etag()
+    if etiqueta and not debil:
+        response.set_etag(etiqueta, weak=True)
+    return response
+
 # ----------------------------------------------------
 # 🌐 Rutas para Servir Archivos HTML
 # ----------------------------------------------------
 
 @app.route('/')
 def serve_login():
-    return send_file('login.html')
+    return servir_pagina('login.html')
 
 @app.route('/login.html')
 def serve_login_direct():
-    return send_file('login.html')
+    return servir_pagina('login.html')
 
 @app.route('/panelAdmin.html')
 def serve_panel_admin():
-    return send_file('panelAdmin.html')
+    return servir_pagina('panelAdmin.html')
 
 @app.route('/vistaprincipal.html')
 def serve_vista_principal():
-    return send_file('vistaprincipal.html')
+    return servir_pagina('vistaprincipal.html')
 
 @app.route('/<path:filename>')
 def serve_static_files(filename):
@@ -768,8 +2656,7 @@ def agendar_terapia_visual_api():
             return jsonify({'message': 'Formato de fecha u hora inválido'}), 400
         
         # Verificar motivo
-        motivo_terapia = MotivoCita.query.get(3)
-        if not motivo_terapia:
+        if 3 not in catalogos.motivos:
             return jsonify({'message': 'Motivo de terapia visual no configurado'}), 500
         
         # Crear paciente
@@ -793,25 +2680,21 @@ def agendar_terapia_visual_api():
              db.session.add(paciente)
              db.session.flush()
         
-        # Asignar gabinete con la NUEVA función (pasando fecha y hora)
-        id_gabinete = get_next_available_gabinete(fecha_inicio, hora_dt)
-        if not id_gabinete:
-             return jsonify({'message': 'No hay gabinetes disponibles para la fecha y hora inicial'}), 400
-        
-        gabinete = Gabinete.query.get(id_gabinete)
-        
-        # Crear cita original
-        cita_original = Cita(
-            fecha=fecha_inicio,
-            hora=hora_dt,
+        # Crear cita original en el primer gabinete libre (reintenta si otra petición lo gana)
+        cita_original = reservar_gabinete(
+            fecha_inicio,
+            hora_dt,
             id_paciente=paciente.id_paciente,
             id_motivo=3,  # Terapia visual
-            id_gabinete=id_gabinete,
             estado='Programada',
             id_usuario=current_user.id_usuario
         )
-        db.session.add(cita_original)
-        db.session.flush()
+        if cita_original is None:
+             db.session.rollback()
+             registrar_reserva('agendar_terapia', 'lleno')
+             return jsonify({'message': 'No hay gabinetes disponibles para la fecha y hora inicial'}), 400
+        
+        nombre_gabinete = catalogos.nombre_gabinete(cita_original.id_gabinete)
         
         # PROCESAR RECURRENCIA
         es_recurrente = data.get('es_recurrente', True)
@@ -842,18 +2725,28 @@ def agendar_terapia_visual_api():
             )
             db.session.add(detalle_original)
 
-            citas_generadas = generar_citas_recurrentes(
-                serie_recurrente.id_serie,
-                paciente.id_paciente,
-                fecha_inicio,
-                fecha_fin,
-                dia_semana,
-                hora_dt,
-                current_user.id_usuario
-            )
-            
+            # Si otra petición ocupa alguno de los horarios mientras tanto, se revierte
+            # solo el bloque de recurrencias y se reserva semana por semana
+            argumentos_serie = (serie_recurrente.id_serie, paciente.id_paciente, fecha_inicio,
+                                fecha_fin, dia_semana, hora_dt, current_user.id_usuario)
+            try:
+                with db.session.begin_nested():
+                    citas_generadas = generar_citas_recurrentes(*argumentos_serie)
+            except IntegrityError:
+                with db.session.begin_nested():
+                    citas_generadas = generar_citas_recurrentes(*argumentos_serie, por_semana=True)
+
+        # IDs tomados antes del commit: después las citas quedan expiradas y leerlos
+        # costaría un SELECT por cita
+        ids_citas = [cita_original.id_cita] + [c.id_cita for c in citas_generadas]
         db.session.commit()
 
+        publicar_evento_agenda('terapia_agendada', {
+            'id_cita_original': ids_citas[0],
+            'ids_citas': ids_citas
+        })
+        registrar_reserva('agendar_terapia', 'exito')
+
         if es_recurrente:
             total_citas = 1 + len(citas_generadas)
             mensaje_final = f'Terapia visual recurrente agendada exitosamente. {total_citas} citas creadas hasta el {fecha_fin}.'
@@ -873,7 +2766,7 @@ def agendar_terapia_visual_api():
                     'edad': paciente.edad,
                     'telefono': paciente.telefono
                 },
-                'gabinete': gabinete.nombre,
+                'gabinete': nombre_gabinete,
                 'estado': cita_original.estado
             },
             'total_citas': total_citas,
@@ -882,7 +2775,8 @@ def agendar_terapia_visual_api():
 
     except Exception as e:
         db.session.rollback()
-        print(f"💥 ERROR CRÍTICO: {str(e)}")
+        registrar_reserva('agendar_terapia', 'error')
+        logger.exception('Error al agendar terapia visual')
         return jsonify({'message': 'Error al agendar terapia visual', 'error': str(e)}), 500
 
 @app.route('/api/citas/<int:cita_id>/editar_individual', methods=['PUT'])
@@ -912,13 +2806,20 @@ def editar_cita_individual(cita_id):
         
         if 'estado' in data:
             cita.estado = data['estado']
+
+        if ('fecha' in data or 'hora' in data) and not reubicar_gabinete_si_ocupado(cita):
+            db.session.rollback()
+            return jsonify({'message': 'Todos los gabinetes están ocupados para el nuevo horario.'}), 409
         
         detalle_serie.estado_individual = 'Modificada'
         db.session.commit()
+
+        cita_dict = cita.to_dict()
+        publicar_evento_agenda('cita_modificada', {'cita': cita_dict, 'id_serie': detalle_serie.id_serie})
         
         return jsonify({
             'message': 'Cita individual modificada exitosamente',
-            'cita': cita.to_dict(),
+            'cita': cita_dict,
             'serie_afectada': False
         }), 200
         
@@ -947,8 +2848,11 @@ def cancelar_serie_completa(serie_id):
         for cita in citas_futuras:
             cita.estado = 'Cancelada'
         
+        ids_cancelados = [cita.id_cita for cita in citas_futuras]
         serie.estado_serie = 'Cancelada'
         db.session.commit()
+
+        publicar_evento_agenda('serie_cancelada', {'id_serie': serie_id, 'citas_canceladas': ids_cancelados})
         
         return jsonify({
             'message': f'Serie completa cancelada. {len(citas_futuras)} citas afectadas.',
@@ -964,32 +2868,117 @@ def cancelar_serie_completa(serie_id):
 
 @app.route('/api/citas/admin_completo', methods=['GET'])
 @login_required
+@con_etag_agenda
 def get_citas_admin_completo():
     """Obtiene todas las citas incluyendo las recurrentes"""
     try:
-        citas_principales = Cita.query.order_by(Cita.fecha, Cita.hora).all()
-        citas_recurrentes = Cita.query.join(CitaRecurrenteDetalle).filter(
-            CitaRecurrenteDetalle.id_cita == Cita.id_cita
-        ).order_by(Cita.fecha, Cita.hora).all()
-        
-        todas_citas = citas_principales + citas_recurrentes
-        todas_citas = list({cita.id_cita: cita for cita in todas_citas}.values())
-        
-        return jsonify([cita.to_dict() for cita in todas_citas]), 200
+        # Las citas recurrentes también son filas de Cita, por lo que una sola
+        # consulta ya las incluye (antes se consultaban dos veces y se deduplicaban)
+        return responder_listado_citas(Cita.query)
         
     except Exception as e:
         return jsonify({'message': 'Error al cargar citas', 'error': str(e)}), 500
 
 @app.route('/api/citas/todas', methods=['GET'])
 @login_required  
+@con_etag_agenda
 def get_todas_citas():
     try:
-        todas_citas = Cita.query.order_by(Cita.fecha, Cita.hora).all()
-        return jsonify([cita.to_dict() for cita in todas_citas]), 200
+        return responder_listado_citas(Cita.query)
     except Exception as e:
         return jsonify({'message': 'Error al cargar citas', 'error': str(e)}), 500
 
 
+@app.route('/api/citas/eventos', methods=['GET'])
+@login_required
+def stream_eventos_agenda():
+    """
+    Canal SSE con los eventos de la agenda (cita_agendada, terapia_agendada,
+    cita_modificada, serie_cancelada, agenda_actualizada). Con Last-Event-ID se
+    reanuda donde se quedó el cliente; si ya no está en el búfer recibe 'recargar'.
+    """
+    if not _vigilante_iniciado.is_set():
+        _vigilante_iniciado.set()
+        threading.Thread(target=_vigilar_version_agenda, daemon=True).start()
+
+    if not canal_agenda.conectar():
+        return jsonify({'message': 'Demasiados paneles conectados, intente más tarde'}), 503
+
+    try:
+        desde = int(request.headers.get('Last-Event-ID', canal_agenda.secuencia))
+    except ValueError:
+        desde = canal_agenda.secuencia
+
+    # El stream puede durar horas: no debe retener una conexión del pool de la base
+    db.session.remove()
+
+    def generar():
+        nonlocal desde
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                eventos = canal_agenda.esperar(desde, SSE_INTERVALO_LATIDO)
+                if eventos is None:
+                    desde = canal_agenda.secuencia
+                    yield f"id: {desde}\nevent: recargar\ndata: {{}}\n\n"
+                elif eventos:
+                    desde = eventos[-1][0]
+                    yield ''.join(texto for _, texto in eventos)
+                else:
+                    yield ': latido\n\n'
+        finally:
+            canal_agenda.desconectar()
+
+    return Response(stream_with_context(generar()), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/api/citas/cambios', methods=['GET'])
+@login_required
+def get_cambios_citas():
+    """
+    Devuelve solo las citas y detalles de series creados, modificados o cancelados
+    desde la versión `since`, para que el panel actualice su copia local.
+    """
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'message': 'El parámetro since debe ser numérico'}), 400
+
+    try:
+        # Versión leída antes que los datos: lo que cambie en medio se reenvía en la siguiente llamada
+        version = obtener_version_agenda()
+
+        citas = con_relaciones_cita(Cita.query.filter(Cita.version_cambio > since)).order_by(
+            Cita.version_cambio, Cita.id_cita
+        ).limit(LIMITE_PAGINA_MAXIMO + 1).all()
+
+        if len(citas) > LIMITE_PAGINA_MAXIMO:
+            # Demasiados cambios: es más barato que el panel recargue el listado completo
+            return jsonify({'version': version, 'recargar': True}), 200
+
+        detalles = CitaRecurrenteDetalle.query.filter(
+            CitaRecurrenteDetalle.version_cambio > since
+        ).order_by(CitaRecurrenteDetalle.version_cambio).limit(LIMITE_PAGINA_MAXIMO + 1).all()
+
+        if len(detalles) > LIMITE_PAGINA_MAXIMO:
+            # Mismo criterio que para las citas: truncar dejaría detalles sin enviar para siempre
+            return jsonify({'version': version, 'recargar': True}), 200
+
+        version = max([version] + [c.version_cambio for c in citas] + [d.version_cambio for d in detalles])
+        return jsonify({
+            'version': version,
+            'recargar': False,
+            'citas': [cita.to_dict() for cita in citas],
+            'canceladas': [cita.id_cita for cita in citas if cita.estado == 'Cancelada'],
+            'detalles_serie': [
+                dict(detalle.to_dict(), id_serie=detalle.id_serie) for detalle in detalles
+            ]
+        }), 200
+
+    except Exception as e:
+        return jsonify({'message': 'Error al obtener cambios de la agenda', 'error': str(e)}), 500
+
+
 # 📅 Rutas para la gestión de disponibilidad de terapia visual
 @app.route('/api/terapia/disponibilidad', methods=['POST'])
 @login_required
@@ -1071,15 +3060,80 @@ def get_horarios_disponibles_terapia():
 
 from datetime import date
 
+DIAS_SEMANA = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+
+def resumen_citas(fecha_inicio, fecha_fin):
+    """
+    Agregados de las citas del rango calculados en la base con GROUP BY:
+    totales por estado, motivo, gabinete, hora y día de la semana, y tasas de
+    inasistencia y cancelación.
+    """
+    en_rango = Cita.fecha.between(fecha_inicio, fecha_fin)
+    conteo = func.count(Cita.id_cita)
+
+    por_estado = dict(
+        db.session.query(func.coalesce(Cita.estado, 'Programada'), conteo)
+        .filter(en_rango).group_by(func.coalesce(Cita.estado, 'Programada')).all()
+    )
+    por_motivo = {}
+    for id_motivo, total in db.session.query(Cita.id_motivo, conteo).filter(en_rango).group_by(Cita.id_motivo):
+        descripcion = catalogos.descripcion_motivo(id_motivo)
+        por_motivo[descripcion] = por_motivo.get(descripcion, 0) + total
+    por_gabinete = {}
+    for id_gabinete, total in db.session.query(Cita.id_gabinete, conteo).filter(en_rango).group_by(Cita.id_gabinete):
+        nombre = catalogos.nombre_gabinete(id_gabinete)
+        por_gabinete[nombre] = por_gabinete.get(nombre, 0) + total
+    por_hora = {
+        str(hora): total for hora, total in
+        db.session.query(Cita.hora, conteo).filter(en_rango).group_by(Cita.hora).order_by(Cita.hora).all()
+    }
+    # El día de la semana se obtiene de los totales por fecha (como mucho una fila por día
+    # del rango), porque las funciones de fecha de MySQL y SQLite no coinciden
+    por_dia_semana = {}
+    for fecha, total in db.session.query(Cita.fecha, conteo).filter(en_rango).group_by(Cita.fecha).all():
+        dia = DIAS_SEMANA[fecha.weekday()]
+        por_dia_semana[dia] = por_dia_semana.get(dia, 0) + total
+
+    total = sum(por_estado.values())
+
+    def tasa(estado):
+        return round(por_estado.get(estado, 0) / total, 4) if total else 0.0
+
+    return {
+        'total': total,
+        'por_estado': por_estado,
+        'por_motivo': por_motivo,
+        'por_gabinete': por_gabinete,
+        'por_hora': por_hora,
+        'por_dia_semana': por_dia_semana,
+        'tasa_inasistencia': tasa('No asistió'),
+        'tasa_cancelacion': tasa('Cancelada')
+    }
+
 @app.route('/api/reportes/semanal', methods=['GET'])
 @login_required
+@con_etag_agenda
 def get_reporte_semanal():
-    """Genera un reporte de todas las citas de los últimos 7 días."""
+    """
+    Genera un reporte de todas las citas de los últimos 7 días, con su resumen agregado.
+    Con ?solo_resumen=1 se omite la lista de citas.
+    """
     try:
         hoy = date.today()
         fecha_inicio = hoy - timedelta(days=6)
+        resumen = resumen_citas(fecha_inicio, hoy)
+
+        if request.args.get('solo_resumen', '').lower() in ('1', 'true', 'si', 'sí'):
+            return jsonify({
+                'resumen': resumen,
+                'fecha_inicio': fecha_inicio.strftime('%Y-%m-%d'),
+                'fecha_fin': hoy.strftime('%Y-%m-%d'),
+                'total': resumen['total']
+            }), 200
         
-        citas_semanales = Cita.query.filter(Cita.fecha.between(fecha_inicio, hoy)).all()
+        citas_semanales = con_relaciones_cita(
+            Cita.query.filter(Cita.fecha.between(fecha_inicio, hoy))
+        ).all()
         
         reporte_data = []
         for cita in citas_semanales:
@@ -1096,6 +3150,7 @@ def get_reporte_semanal():
 
         return jsonify({
             'citas': reporte_data,
+            'resumen': resumen,
             'fecha_inicio': fecha_inicio.strftime('%Y-%m-%d'),
             'fecha_fin': hoy.strftime('%Y-%m-%d'),
             'total': len(reporte_data)
@@ -1104,11 +3159,150 @@ def get_reporte_semanal():
     except Exception as e:
         return jsonify({'message': 'Error interno al generar el reporte semanal', 'error': str(e)}), 500
 
+@app.route('/api/reportes/estadisticas', methods=['GET'])
+@login_required
+@con_etag_agenda
+def get_estadisticas():
+    """
+    Totales por periodo (agrupar=dia|semana|mes|anio) leídos de la estadística diaria
+    pre-agregada, sin recorrer las citas individuales.
+    """
+    if not request.args.get('desde') or not request.args.get('hasta'):
+        return jsonify({'message': 'Los parámetros desde y hasta son requeridos'}), 400
+
+    try:
+        desde = datetime.strptime(request.args['desde'], '%Y-%m-%d').date()
+        hasta = datetime.strptime(request.args['hasta'], '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'message': 'Formato de fecha inválido. Use YYYY-MM-DD'}), 400
+
+    formatos_periodo = {
+        'dia': lambda f: f.strftime('%Y-%m-%d'),
+        'semana': lambda f: '{}-S{:02d}'.format(*f.isocalendar()[:2]),
+        'mes': lambda f: f.strftime('%Y-%m'),
+        'anio': lambda f: f.strftime('%Y'),
+    }
+    agrupar = request.args.get('agrupar', 'dia')
+    if agrupar not in formatos_periodo:
+        return jsonify({'message': 'agrupar debe ser dia, semana, mes o anio'}), 400
+
+    try:
+        motivos = catalogos.motivos
+        gabinetes = catalogos.gabinetes
+        filas = EstadisticaDiaria.query.filter(
+            EstadisticaDiaria.fecha.between(desde, hasta), EstadisticaDiaria.total > 0
+        ).all()
+
+        periodos = {}
+        for fila in filas:
+            periodo = periodos.setdefault(formatos_periodo[agrupar](fila.fecha), {
+                'total': 0, 'por_estado': {}, 'por_motivo': {}, 'por_gabinete': {}
+            })
+            periodo['total'] += fila.total
+            for grupo, clave in (('por_estado', fila.estado),
+                                 ('por_motivo', motivos.get(fila.id_motivo, 'N/A')),
+                                 ('por_gabinete', gabinetes.get(fila.id_gabinete, 'N/A'))):
+                periodo[grupo][clave] = periodo[grupo].get(clave, 0) + fila.total
+
+        return jsonify({
+            'desde': desde.strftime('%Y-%m-%d'),
+            'hasta': hasta.strftime('%Y-%m-%d'),
+            'agrupar': agrupar,
+            'periodos': periodos
+        }), 200
+
+    except Exception as e:
+        return jsonify({'message': 'Error al obtener estadísticas', 'error': str(e)}), 500
+
+COLUMNAS_EXPORTACION = ['id_cita', 'fecha', 'hora', 'nombre_completo', 'telefono', 'motivo', 'gabinete', 'estado']
+
+@app.route('/api/reportes/export', methods=['GET'])
+@login_required
+def exportar_reporte():
+    """
+    Exporta las citas de cualquier rango (desde/hasta) en CSV o JSON Lines (formato=csv|jsonl).
+    Las filas se leen por lotes de un cursor del servidor y se escriben conforme llegan,
+    así que un semestre se exporta con memoria constante.
+    """
+    if not request.args.get('desde') or not request.args.get('hasta'):
+        return jsonify({'message': 'Los parámetros desde y hasta son requeridos'}), 400
+
+    formato = request.args.get('formato', 'csv').lower()
+    if formato not in ('csv', 'jsonl'):
+        return jsonify({'message': 'Formato no soportado. Use csv o jsonl'}), 400
+
+    try:
+        filtros = leer_filtros_listado(request.args)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    if filtros['hasta'] < filtros['desde']:
+        return jsonify({'message': 'La fecha hasta debe ser posterior a desde'}), 400
+
+    # Solo columnas (sin objetos ORM) para que cada fila cueste lo mínimo
+    query = aplicar_filtros_citas(
+        db.session.query(
+            Cita.id_cita, Cita.fecha, Cita.hora,
+            Paciente.nombre, Paciente.apellido, Paciente.telefono,
+            Cita.id_motivo, Cita.id_gabinete, Cita.estado
+        ).select_from(Cita)
+        .outerjoin(Paciente, Cita.id_paciente == Paciente.id_paciente),
+        filtros
+    ).order_by(Cita.fecha, Cita.hora, Cita.id_cita)
+
+    def filas():
+        motivos, gabinetes = catalogos.motivos, catalogos.gabinetes
+        resultado = db.session.execute(query.statement.execution_options(yield_per=TAMANO_LOTE_STREAM))
+        for id_cita, fecha, hora, nombre, apellido, telefono, id_motivo, id_gabinete, estado in resultado:
+            yield [
+                id_cita,
+                fecha.strftime('%Y-%m-%d'),
+                str(hora),
+                f"{nombre} {apellido}" if nombre is not None else 'Paciente Eliminado',
+                telefono or '',
+                motivos.get(id_motivo, 'N/A'),
+                gabinetes.get(id_gabinete, 'N/A'),
+                estado
+            ]
+
+    def generar_csv():
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        escritor.writerow(COLUMNAS_EXPORTACION)
+        for numero, fila in enumerate(filas(), start=1):
+            escritor.writerow(fila)
+            if numero % TAMANO_LOTE_STREAM == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    def generar_jsonl():
+        lote = []
+        for fila in filas():
+            lote.append(json.dumps(dict(zip(COLUMNAS_EXPORTACION, fila)), ensure_ascii=False))
+            if len(lote) >= TAMANO_LOTE_STREAM:
+                yield '\n'.join(lote) + '\n'
+                lote = []
+        if lote:
+            yield '\n'.join(lote) + '\n'
+
+    nombre_archivo = f"citas_{filtros['desde']:%Y%m%d}_{filtros['hasta']:%Y%m%d}.{formato}"
+    if formato == 'csv':
+        generador, tipo = generar_csv(), 'text/csv; charset=utf-8'
+    else:
+        generador, tipo = generar_jsonl(), 'application/x-ndjson; charset=utf-8'
+
+    return Response(stream_with_context(generador), content_type=tipo, headers={
+        'Content-Disposition': f'attachment; filename="{nombre_archivo}"'
+    })
+
 # ----------------------------------------------------
 # 🚀 Ejecución de la Aplicación
 # ----------------------------------------------------
 
 if __name__ == '__main__':
     inicializar_db() 
+    obtener_activos()
     print("🚀 Servidor Flask iniciado en http://127.0.0.1:5000")
     app.run(debug=True, host='127.0.0.1', port=5000, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,325 @@
+# benchmark.py - CARGA SINTÉTICA Y MEDICIÓN DE LATENCIA DE LA API
+#
+# Uso:
+#   python benchmark.py --pacientes 2000 --anios 2 --series 150 --concurrencia 8 --peticiones 300
+#   python benchmark.py --db mysql+pymysql://root:@localhost/bench_optometria --salida bench.json
+#   python benchmark.py --sin-sembrar --url http://127.0.0.1:5000   (servidor ya levantado)
+#
+# Siembra una base (SQLite por defecto) con los modelos de app.py, ejecuta los endpoints
+# reales con el cliente de pruebas de Flask (o contra un servidor local) y escribe en JSON
+# la latencia p50/p95/p99 y el throughput de cada endpoint, para comparar entre versiones.
+
+import argparse
+import contextlib
+import http.cookiejar
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark de la API de citas de optometría')
+    parser.add_argument('--db', default='sqlite:///benchmark.db',
+                        help='URI de la base a sembrar y usar (por defecto sqlite:///benchmark.db)')
+    parser.add_argument('--url', default=None,
+                        help='URL de un servidor local; si se omite se usa el cliente de pruebas de Flask')
+    parser.add_argument('--pacientes', type=int, default=1000)
+    parser.add_argument('--anios', type=float, default=1.0, help='Años de historial de citas')
+    parser.add_argument('--ocupacion', type=float, default=0.6,
+                        help='Fracción media de gabinetes ocupados por horario (0-1)')
+    parser.add_argument('--series', type=int, default=100, help='Series de terapia visual')
+    parser.add_argument('--concurrencia', type=int, default=4)
+    parser.add_argument('--peticiones', type=int, default=200, help='Peticiones por endpoint')
+    parser.add_argument('--endpoints', default='agendar,disponibilidad,agendar_terapia,todas,semanal',
+                        help='Lista separada por comas de los escenarios a ejecutar')
+    parser.add_argument('--semilla', type=int, default=2025)
+    parser.add_argument('--sin-sembrar', action='store_true', help='Usa la base tal como está')
+    parser.add_argument('--salida', default=None, help='Archivo JSON de resultados (por defecto stdout)')
+    args = parser.parse_args()
+    if args.url and not args.sin_sembrar:
+        # La siembra recrea la base local de --db, no la del servidor que se mide
+        parser.error('--url requiere --sin-sembrar (siembre la base del servidor por separado)')
+    return args
+
+
+# ----------------------------------------------------
+# 🌱 Siembra de datos sintéticos
+# ----------------------------------------------------
+
+def sembrar(modulo, args, rng):
+    """Crea la base desde cero con pacientes, historial de citas y series de terapia."""
+    app, db = modulo.app, modulo.db
+    Cita, Paciente = modulo.Cita, modulo.Paciente
+    insert = modulo.insert
+
+    with app.app_context():
+        db.drop_all()
+    modulo.inicializar_db()
+
+    with app.app_context():
+        db.session.execute(insert(Paciente), [
+            {'nombre': f'Paciente{i}', 'apellido': 'Sintetico', 'edad': rng.randint(5, 80),
+             'telefono': f'1{i:09d}'}
+            for i in range(args.pacientes)
+        ])
+        ids_pacientes = [i for (i,) in db.session.query(Paciente.id_paciente).all()]
+
+        horas = [datetime.strptime(h, '%H:%M:%S').time() for h in modulo.Config.HORARIOS_ATENCION]
+        gabinetes = [g['id'] for g in modulo.Config.GABINETES]
+        motivos = [m['id'] for m in modulo.Config.MOTIVOS_CITA]
+        estados = ['Completada'] * 6 + ['Cancelada', 'No asistió', 'Programada']
+
+        hoy = date.today()
+        primer_dia = hoy - timedelta(days=int(365 * args.anios))
+        ultimo_dia = hoy + timedelta(days=30)
+        ocupacion = {}  # (fecha, hora) -> gabinetes ya usados, para respetar uq_cita_horario_gabinete
+
+        def estado_en(fecha):
+            return rng.choice(estados) if fecha < hoy else 'Programada'
+
+        # Series de terapia primero: como las de agendar_terapia, el mismo paciente a la misma
+        # hora durante 13 semanas seguidas (cita original + 12 detalles)
+        semanas = [[] for _ in range(args.series)]
+        filas_series = []
+        for serie in semanas:
+            inicio = primer_dia + timedelta(days=rng.randint(0, max(0, (ultimo_dia - primer_dia).days - 84)))
+            while inicio.weekday() >= 5:
+                inicio += timedelta(days=1)
+            hora, id_paciente = rng.choice(horas), rng.choice(ids_pacientes)
+            for semana in range(13):
+                fecha = inicio + timedelta(weeks=semana)
+                usados = ocupacion.setdefault((fecha, hora), set())
+                id_gabinete = next((g for g in gabinetes if g not in usados), None)
+                if id_gabinete is None:
+                    continue  # semana llena: la serie la omite, igual que generar_citas_recurrentes
+                usados.add(id_gabinete)
+                serie.append((fecha, hora, id_gabinete))
+                filas_series.append({
+                    'fecha': fecha, 'hora': hora, 'id_paciente': id_paciente, 'id_motivo': 3,
+                    'id_gabinete': id_gabinete, 'estado': estado_en(fecha)
+                })
+        if filas_series:
+            db.session.execute(insert(Cita), filas_series)
+        ids_por_horario = {
+            (f, h, g): i for i, f, h, g in db.session.query(
+                Cita.id_cita, Cita.fecha, Cita.hora, Cita.id_gabinete).filter(Cita.id_motivo == 3)
+        }
+
+        total_series = 0
+        for serie in semanas:
+            if len(serie) < 2:
+                continue
+            (fecha_inicio, hora, _), detalles = serie[0], serie[1:]
+            registro = modulo.CitaRecurrente(
+                id_cita_original=ids_por_horario[serie[0]], fecha_inicio=fecha_inicio,
+                fecha_fin=serie[-1][0], dia_semana=fecha_inicio.weekday(),
+                hora=hora, estado_serie='Activa'
+            )
+            db.session.add(registro)
+            db.session.flush()
+            db.session.execute(insert(modulo.CitaRecurrenteDetalle), [
+                {'id_serie': registro.id_serie, 'id_cita': ids_por_horario[clave],
+                 'fecha_programada': clave[0], 'estado_individual': 'Programada'}
+                for clave in detalles
+            ])
+            total_series += 1
+        total_citas = len(filas_series)
+
+        # Historial aleatorio en los gabinetes que dejaron libres las series
+        dia = primer_dia
+        lote = []
+        while dia <= ultimo_dia:
+            if dia.weekday() < 5:
+                for hora in horas:
+                    libres = [g for g in gabinetes if g not in ocupacion.get((dia, hora), ())]
+                    ocupados = sum(1 for _ in libres if rng.random() < args.ocupacion)
+                    for id_gabinete in rng.sample(libres, ocupados):
+                        lote.append({
+                            'fecha': dia, 'hora': hora,
+                            'id_paciente': rng.choice(ids_pacientes),
+                            'id_motivo': rng.choice(motivos),
+                            'id_gabinete': id_gabinete,
+                            'estado': estado_en(dia)
+                        })
+            if len(lote) >= 5000:
+                db.session.execute(insert(Cita), lote)
+                total_citas += len(lote)
+                lote = []
+            dia += timedelta(days=1)
+        if lote:
+            db.session.execute(insert(Cita), lote)
+            total_citas += len(lote)
+        db.session.commit()
+        modulo.recalcular_estadisticas()
+
+    return {'pacientes': args.pacientes, 'citas': total_citas, 'series': total_series}
+
+
+# ----------------------------------------------------
+# 🔌 Clientes: Flask test client o servidor HTTP local
+# ----------------------------------------------------
+
+class ClienteFlask:
+    def __init__(self, app):
+        self._cliente = app.test_client()
+
+    def peticion(self, metodo, ruta, datos=None):
+        respuesta = self._cliente.open(ruta, method=metodo, json=datos)
+        respuesta.get_data()  # consume también las respuestas en streaming
+        return respuesta.status_code
+
+
+class ClienteHTTP:
+    def __init__(self, url_base):
+        self._url = url_base.rstrip('/')
+        self._opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def peticion(self, metodo, ruta, datos=None):
+        cuerpo = json.dumps(datos).encode('utf-8') if datos is not None else None
+        solicitud = urllib.request.Request(self._url + ruta, data=cuerpo, method=metodo,
+                                           headers={'Content-Type': 'application/json'})
+        try:
+            with self._opener.open(solicitud) as respuesta:
+                respuesta.read()
+                return respuesta.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+# ----------------------------------------------------
+# 🏁 Escenarios y medición
+# ----------------------------------------------------
+
+def fecha_habil_aleatoria(rng, dias=90):
+    while True:
+        fecha = date.today() + timedelta(days=rng.randint(1, dias))
+        if fecha.weekday() < 5:
+            return fecha.strftime('%Y-%m-%d')
+
+
+def construir_escenarios(horarios):
+    contador = iter(range(10 ** 9))
+    lock = threading.Lock()
+
+    def telefono_nuevo():
+        with lock:
+            return f'9{next(contador):09d}'
+
+    return {
+        'agendar': lambda rng: ('POST', '/api/citas/agendar', {
+            'fecha': fecha_habil_aleatoria(rng), 'hora': rng.choice(horarios), 'id_motivo': rng.choice([1, 2]),
+            'es_nuevo': True, 'nombre': 'Bench', 'apellido': 'Carga', 'edad': 30, 'telefono': telefono_nuevo()
+        }),
+        'disponibilidad': lambda rng: ('POST', '/api/citas/disponibilidad', {'fecha': fecha_habil_aleatoria(rng)}),
+        'agendar_terapia': lambda rng: ('POST', '/api/citas/agendar_terapia', {
+            'nombre_paciente': 'Bench Terapia', 'fecha_inicio': fecha_habil_aleatoria(rng),
+            'hora': rng.choice(horarios), 'telefono': telefono_nuevo(), 'edad': 10
+        }),
+        'todas': lambda rng: ('GET', '/api/citas/todas', None),
+        'semanal': lambda rng: ('GET', '/api/reportes/semanal', None),
+    }
+
+
+def percentil(valores_ordenados, p):
+    if not valores_ordenados:
+        return None
+    indice = max(0, min(len(valores_ordenados) - 1, int(round(p / 100 * len(valores_ordenados))) - 1))
+    return valores_ordenados[indice]
+
+
+def ejecutar_escenario(nombre, generador, crear_cliente, args):
+    """Ejecuta `peticiones` llamadas con `concurrencia` hilos; cada hilo tiene su sesión."""
+    locales = threading.local()
+    latencias = []
+    codigos = {}
+    lock = threading.Lock()
+
+    def una_peticion(i):
+        if not hasattr(locales, 'cliente'):
+            locales.cliente = crear_cliente()
+            locales.cliente.peticion('POST', '/login', {'username': 'admin', 'password': 'adminUAL'})
+            locales.rng = random.Random(args.semilla + i)
+        metodo, ruta, datos = generador(locales.rng)
+        inicio = time.perf_counter()
+        codigo = locales.cliente.peticion(metodo, ruta, datos)
+        duracion = time.perf_counter() - inicio
+        with lock:
+            latencias.append(duracion)
+            codigos[str(codigo)] = codigos.get(str(codigo), 0) + 1
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as ejecutor:
+        list(ejecutor.map(una_peticion, range(args.peticiones)))
+    total = time.perf_counter() - inicio
+
+    latencias.sort()
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        'endpoint': nombre,
+        'peticiones': len(latencias),
+        'concurrencia': args.concurrencia,
+        'codigos': codigos,
+        'p50_ms': ms(percentil(latencias, 50)),
+        'p95_ms': ms(percentil(latencias, 95)),
+        'p99_ms': ms(percentil(latencias, 99)),
+        'max_ms': ms(latencias[-1] if latencias else None),
+        'throughput_rps': round(len(latencias) / total, 2) if total else None
+    }
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.semilla)
+
+    # La URI debe fijarse antes de importar la aplicación (config.py la lee al importarse)
+    os.environ['DATABASE_URL'] = args.db
+    os.environ.setdefault('LOG_NIVEL', 'WARNING')  # sin una línea de log por reserva durante la medición
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    salida_real = sys.stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as modulo
+
+        datos = {'sembrado': False}
+        if not args.sin_sembrar:
+            datos = dict(sembrar(modulo, args, rng), sembrado=True)
+
+        if args.url:
+            crear_cliente = lambda: ClienteHTTP(args.url)
+        else:
+            crear_cliente = lambda: ClienteFlask(modulo.app)
+
+        escenarios = construir_escenarios(modulo.Config.HORARIOS_ATENCION)
+        resultados = []
+        for nombre in [e.strip() for e in args.endpoints.split(',') if e.strip()]:
+            if nombre not in escenarios:
+                raise SystemExit(f'Escenario desconocido: {nombre}')
+            resultados.append(ejecutar_escenario(nombre, escenarios[nombre], crear_cliente, args))
+
+    reporte = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'base': args.db if not args.url else None,
+        'servidor': args.url,
+        'datos': datos,
+        'resultados': resultados
+    }
+    texto = json.dumps(reporte, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as archivo:
+            archivo.write(texto + '\n')
+    else:
+        print(texto, file=salida_real)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,8 @@ class Config:
     # Clave secreta PARA DESARROLLO - en producción usar variable de entorno
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'clave_super_secreta_para_desarrollo_2025_optometria_ual'
     
-    # Configuración de la base de datos MySQL
-    SQLALCHEMY_DATABASE_URI = 'mysql+pymysql://root:@localhost/ual_optometria'
+    # Configuración de la base de datos MySQL (DATABASE_URL permite apuntar a otra base, p. ej. benchmarks)
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'mysql+pymysql://root:@localhost/ual_optometria'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
     # Configuración de sesión CRÍTICA
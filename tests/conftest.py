@@ -0,0 +1,109 @@
+# conftest.py - BASE SQLITE TEMPORAL Y CONTADOR DE CONSULTAS PARA LAS PRUEBAS
+
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import pytest
+
+# La base debe fijarse antes de importar app (config.py lee DATABASE_URL al importarse)
+_directorio = tempfile.mkdtemp(prefix='optometria_tests_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_directorio, 'pruebas.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as modulo_app  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+
+class ContadorConsultas:
+    """Cuenta las sentencias SQL y el tiempo de pared dentro de un bloque `medir()`."""
+
+    def __init__(self):
+        self.sentencias = []
+        self.segundos = 0.0
+        self._activo = False
+
+    def _al_ejecutar(self, conexion, cursor, sentencia, parametros, contexto, executemany):
+        if self._activo:
+            self.sentencias.append(sentencia)
+
+    @property
+    def total(self):
+        return len(self.sentencias)
+
+    @contextmanager
+    def medir(self):
+        self.sentencias = []
+        self._activo = True
+        inicio = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.segundos = time.perf_counter() - inicio
+            self._activo = False
+
+
+@pytest.fixture(scope='session')
+def app():
+    return modulo_app
+
+
+@pytest.fixture
+def base(app):
+    """Base vacía con los datos iniciales de inicializar_db."""
+    with app.app.app_context():
+        app.db.drop_all()
+    app.invalidar_ocupacion()
+    app.invalidar_usuarios()
+    app.inicializar_db()
+    return app
+
+
+@pytest.fixture
+def cliente(base):
+    cliente = base.app.test_client()
+    respuesta = cliente.post('/login', json={'username': 'admin', 'password': 'adminUAL'})
+    assert respuesta.status_code == 200
+    return cliente
+
+
+@pytest.fixture
+def consultas(base):
+    contador = ContadorConsultas()
+    with base.app.app_context():
+        motor = base.db.engine
+    event.listen(motor, 'before_cursor_execute', contador._al_ejecutar)
+    yield contador
+    event.remove(motor, 'before_cursor_execute', contador._al_ejecutar)
+
+
+@pytest.fixture
+def sembrar(base):
+    """Inserta en bloque `dias` días hábiles de citas desde hoy, `por_horario` gabinetes por hora."""
+    def _sembrar(dias, por_horario=3, pacientes=50):
+        app = base
+        with app.app.app_context():
+            app.db.session.execute(app.insert(app.Paciente), [
+                {'nombre': f'P{i}', 'apellido': 'Prueba', 'edad': 30, 'telefono': f'7{i:09d}'}
+                for i in range(pacientes)
+            ])
+            horas = [datetime.strptime(h, '%H:%M:%S').time() for h in app.Config.HORARIOS_ATENCION]
+            filas = []
+            dia = date.today() - timedelta(days=dias // 2)
+            for _ in range(dias):
+                for hora in horas:
+                    for id_gabinete in range(1, por_horario + 1):
+                        filas.append({
+                            'fecha': dia, 'hora': hora, 'id_paciente': 1 + len(filas) % pacientes,
+                            'id_motivo': 1 + len(filas) % 3, 'id_gabinete': id_gabinete,
+                            'estado': 'Programada'
+                        })
+                dia += timedelta(days=1)
+            app.db.session.execute(app.insert(app.Cita), filas)
+            app.db.session.commit()
+        app.invalidar_ocupacion()
+        return len(filas)
+    return _sembrar
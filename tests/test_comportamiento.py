@@ -0,0 +1,507 @@
+# test_comportamiento.py - PRUEBAS DE COMPORTAMIENTO DE LA API (CONCURRENCIA, CACHÉ, COMPRESIÓN)
+
+import gzip
+import hashlib
+import json
+import os
+import re
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+
+def _proximo_dia_habil(dias=1):
+    fecha = date.today() + timedelta(days=dias)
+    while fecha.weekday() >= 5:
+        fecha += timedelta(days=1)
+    return fecha
+
+
+def _estadistica(app):
+    """Totales de la estadística diaria, sin las filas en cero"""
+    with app.app.app_context():
+        tabla = app.EstadisticaDiaria
+        return sorted(
+            (f.fecha, f.id_gabinete, f.id_motivo, f.estado, f.total)
+            for f in tabla.query.filter(tabla.total > 0)
+        )
+
+
+def test_terapia_reserva_semana_por_semana_si_el_bloque_choca(app, cliente, monkeypatch):
+    """Si el INSERT en bloque choca, las semanas se reservan excluyendo los gabinetes perdidos."""
+    inicio = _proximo_dia_habil()
+    hora = datetime.strptime('12:30:00', '%H:%M:%S').time()
+
+    # Otra petición ocupó el gabinete 1 de la segunda semana sin que la ocupación en caché lo sepa
+    with app.app.app_context():
+        app.obtener_gabinetes_ocupados(inicio + timedelta(days=7), hora)
+        app.db.session.execute(app.insert(app.Paciente), [
+            {'nombre': 'Otro', 'apellido': 'Paciente', 'edad': 30, 'telefono': '5559999'}
+        ])
+        app.db.session.execute(app.insert(app.Cita), [{
+            'fecha': inicio + timedelta(days=7), 'hora': hora, 'id_paciente': 1,
+            'id_motivo': 1, 'id_gabinete': 1, 'estado': 'Programada'
+        }])
+        app.db.session.commit()
+        app.recalcular_estadisticas()
+
+    def bloque_en_conflicto(*args):
+        raise IntegrityError('INSERT INTO cita', {}, Exception('uq_cita_horario_gabinete'))
+    monkeypatch.setattr(app, '_insertar_citas_en_bloque', bloque_en_conflicto)
+
+    respuesta = cliente.post('/api/citas/agendar_terapia', json={
+        'nombre_paciente': 'Serie Respaldo', 'fecha_inicio': inicio.strftime('%Y-%m-%d'),
+        'hora': '12:30:00', 'telefono': '5550004'
+    })
+
+    assert respuesta.status_code == 201, respuesta.get_data(as_text=True)
+    assert respuesta.get_json()['total_citas'] == 13
+    with app.app.app_context():
+        segunda = app.Cita.query.filter_by(fecha=inicio + timedelta(days=7), id_motivo=3).one()
+        assert segunda.id_gabinete == 2
+        assert app.CitaRecurrenteDetalle.query.count() == 13
+
+    incremental = _estadistica(app)
+    with app.app.app_context():
+        app.recalcular_estadisticas()
+    assert incremental == _estadistica(app)
+
+
+def test_migracion_fallida_detiene_el_arranque_sin_bloquear_las_independientes(app, base, monkeypatch):
+    aplicadas = []
+
+    def falla():
+        raise RuntimeError('datos inconsistentes')
+
+    monkeypatch.setattr(app, 'MIGRACIONES', [
+        (98, 'Falla', falla, ()),
+        (99, 'Independiente', lambda: aplicadas.append(99), ()),
+        (100, 'Dependiente', lambda: aplicadas.append(100), (98,)),
+    ])
+    with app.app.app_context():
+        with pytest.raises(RuntimeError, match='98: datos inconsistentes'):
+            app.aplicar_migraciones()
+        versiones = {v for (v,) in app.db.session.query(app.VersionEsquema.version)}
+
+    assert aplicadas == [99]
+    assert 99 in versiones and 98 not in versiones and 100 not in versiones
+
+
+def test_paginacion_por_cursor_recorre_todo_sin_huecos_ni_repetidos(app, cliente, sembrar):
+    sembrar(6)  # 6 días x 4 horarios x 3 gabinetes
+    completo = cliente.get('/api/citas/todas').get_json()
+    esperados = [c['id_cita'] for c in sorted(completo, key=lambda c: (c['fecha'], c['hora'], c['id_cita']))]
+
+    vistos, cursor, paginas = [], None, 0
+    while True:
+        ruta = '/api/citas/todas?limite=7' + (f'&cursor={cursor}' if cursor else '')
+        pagina = cliente.get(ruta).get_json()
+        vistos += [c['id_cita'] for c in pagina['citas']]
+        paginas += 1
+        if paginas == 2:
+            # Una cita nueva anterior al cursor no debe desplazar las páginas siguientes
+            with app.app.app_context():
+                app.db.session.execute(app.insert(app.Cita), [{
+                    'fecha': date.today() - timedelta(days=30), 'hora': datetime.strptime('12:30:00', '%H:%M:%S').time(),
+                    'id_paciente': 1, 'id_motivo': 1, 'id_gabinete': 1, 'estado': 'Programada'
+                }])
+                app.db.session.commit()
+        cursor = pagina['siguiente_cursor']
+        if cursor is None:
+            break
+
+    assert vistos == esperados
+    assert paginas == -(-len(esperados) // 7)
+
+
+def test_etag_de_agenda_responde_304_hasta_que_cambia_la_agenda(cliente, sembrar):
+    sembrar(2)
+    primera = cliente.get('/api/citas/todas')
+    primera.get_data()
+    etiqueta = primera.headers['ETag']
+    assert primera.status_code == 200 and etiqueta
+
+    sin_cambios = cliente.get('/api/citas/todas', headers={'If-None-Match': etiqueta})
+    assert sin_cambios.status_code == 304
+    assert sin_cambios.get_data() == b''
+
+    respuesta = cliente.post('/api/citas/agendar_terapia', json={
+        'nombre_paciente': 'Cambio Agenda', 'fecha_inicio': _proximo_dia_habil().strftime('%Y-%m-%d'),
+        'hora': '14:30:00', 'telefono': '5550005', 'es_recurrente': False
+    })
+    assert respuesta.status_code == 201
+
+    despues = cliente.get('/api/citas/todas', headers={'If-None-Match': etiqueta})
+    assert despues.status_code == 200
+    assert despues.headers['ETag'] != etiqueta
+    despues.get_data()
+
+
+def test_cambios_piden_recargar_si_los_detalles_de_serie_desbordan_la_pagina(app, cliente, monkeypatch):
+    respuesta = cliente.post('/api/citas/agendar_terapia', json={
+        'nombre_paciente': 'Serie Larga', 'fecha_inicio': _proximo_dia_habil().strftime('%Y-%m-%d'),
+        'hora': '12:30:00', 'telefono': '5550006', 'es_recurrente': True
+    })
+    assert respuesta.status_code == 201
+
+    listado = cliente.get('/api/citas/todas')
+    listado.get_data()
+    version = int(listado.headers['X-Version-Agenda'])
+
+    # Solo cambian los detalles de la serie: las citas caben en la página, los detalles no
+    with app.app.app_context():
+        app.db.session.execute(app.update(app.CitaRecurrenteDetalle).values(version_cambio=version + 1))
+        app.db.session.execute(app.update(app.VersionAgenda).values(version=version + 1))
+        app.db.session.commit()
+    monkeypatch.setattr(app, 'LIMITE_PAGINA_MAXIMO', 5)
+
+    cambios = cliente.get(f'/api/citas/cambios?since={version}').get_json()
+    assert cambios == {'version': version + 1, 'recargar': True}
+
+
+def test_canal_de_eventos_pide_recargar_si_el_cursor_es_posterior_al_canal(app):
+    canal = app.CanalEventosAgenda()
+    for _ in range(3):
+        canal.publicar('cita_agendada', {})
+
+    # Un Last-Event-ID de antes de reiniciar el proceso no debe dejar al panel esperando
+    assert canal.esperar(50, 0.1) is None
+    assert [secuencia for secuencia, _ in canal.esperar(1, 0.1)] == [2, 3]
+    assert canal.esperar(3, 0.1) == []
+
+
+def test_listado_en_streaming_se_aborta_si_falla_a_mitad(app, cliente, sembrar, monkeypatch):
+    sembrar(1)
+
+    def to_dict_roto(self):
+        raise RuntimeError('fila ilegible')
+    monkeypatch.setattr(app.Cita, 'to_dict', to_dict_roto)
+
+    respuesta = cliente.get('/api/citas/todas')
+    assert respuesta.status_code == 200
+    # Un arreglo cerrado con ']' parecería un listado completo y válido
+    with pytest.raises(RuntimeError, match='fila ilegible'):
+        respuesta.get_data()
+
+
+def test_savepoint_revertido_conserva_lo_anotado_por_la_transaccion(app, base):
+    fecha = _proximo_dia_habil()
+    hora = datetime.strptime('13:30:00', '%H:%M:%S').time()
+
+    with app.app.app_context():
+        sesion = app.db.session
+        version = app.obtener_version_agenda()
+        assert app.obtener_gabinetes_ocupados(fecha, hora) == set()  # queda en caché
+
+        paciente = app.Paciente(nombre='Punto', apellido='Guardado', edad=40, telefono='5550007')
+        sesion.add(paciente)
+        sesion.flush()
+        sesion.add(app.Cita(fecha=fecha, hora=hora, id_paciente=paciente.id_paciente,
+                            id_motivo=1, id_gabinete=1, estado='Programada'))
+        sesion.flush()
+
+        # Un segundo intento sobre el mismo gabinete choca y solo se revierte su SAVEPOINT
+        with pytest.raises(IntegrityError):
+            with sesion.begin_nested():
+                sesion.add(app.Cita(fecha=fecha, hora=hora, id_paciente=paciente.id_paciente,
+                                    id_motivo=1, id_gabinete=1, estado='Programada'))
+                sesion.flush()
+        sesion.commit()
+
+        assert app.obtener_version_agenda() == version + 1
+        assert app.obtener_gabinetes_ocupados(fecha, hora) == {1}
+    assert _estadistica(app) == [(fecha, 1, 1, 'Programada', 1)]
+
+
+def test_no_store_solo_en_la_api(cliente):
+    api = cliente.get('/api/user/current')
+    assert 'no-store' in api.headers['Cache-Control']
+
+    # Los archivos sueltos se revalidan con su ETag en lugar de descargarse siempre
+    estatico = cliente.get('/styles.css')
+    estatico.close()
+    assert estatico.status_code == 200
+    assert 'no-store' not in estatico.headers['Cache-Control']
+    assert estatico.headers['ETag']
+
+
+def test_compresion_gzip_negociada_con_etag_debil(cliente, sembrar):
+    sembrar(2)
+
+    plano = cliente.get('/api/citas/todas?limite=100')
+    comprimido = cliente.get('/api/citas/todas?limite=100', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in plano.headers
+    assert comprimido.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in comprimido.headers['Vary']
+    assert json.loads(gzip.decompress(comprimido.get_data())) == plano.get_json()
+
+    # El cuerpo comprimido no es idéntico byte a byte: la etiqueta pasa a débil y sigue validando
+    etiqueta = comprimido.headers['ETag']
+    assert etiqueta == 'W/' + plano.headers['ETag']
+    revalidado = cliente.get('/api/citas/todas?limite=100',
+                             headers={'Accept-Encoding': 'gzip', 'If-None-Match': etiqueta})
+    assert revalidado.status_code == 304
+    assert 'Content-Encoding' not in revalidado.headers
+
+
+def test_respuestas_pequenas_no_se_comprimen(app, cliente):
+    respuesta = cliente.get('/api/user/current', headers={'Accept-Encoding': 'gzip'})
+    assert len(respuesta.get_data()) < app.COMPRESION_MIN_BYTES
+    assert 'Content-Encoding' not in respuesta.headers
+    assert 'Accept-Encoding' in respuesta.headers['Vary']
+
+
+def test_lote_rechaza_tipos_invalidos_sin_error_interno(cliente):
+    base = {'fecha': _proximo_dia_habil().strftime('%Y-%m-%d'), 'hora': '12:30:00', 'es_nuevo': True,
+            'nombre': 'Tipo', 'apellido': 'Raro', 'edad': 20}
+    respuesta = cliente.post('/api/citas/agendar_lote', json={'citas': [
+        dict(base, id_motivo=[1], telefono='5550010'),
+        dict(base, id_motivo=True, telefono='5550011'),
+        dict(base, id_motivo=1, telefono=['5550012']),
+    ]})
+    assert respuesta.status_code == 400
+    assert [r['resultado'] for r in respuesta.get_json()['resultados']] == ['rechazada'] * 3
+
+
+def test_lote_con_un_paciente_mal_formado_agenda_el_resto(app, cliente):
+    base = {'fecha': _proximo_dia_habil().strftime('%Y-%m-%d'), 'hora': '13:30:00', 'id_motivo': 1,
+            'es_nuevo': True, 'nombre': 'Bien', 'apellido': 'Formado', 'edad': 20}
+    respuesta = cliente.post('/api/citas/agendar_lote', json={'citas': [
+        dict(base, telefono='5550030'),
+        dict(base, telefono='5550031', nombre=None),
+        dict(base, telefono='5550032', edad=[1]),
+        dict(base, telefono='5550033', apellido='x' * 51),
+        dict(base, telefono='5550034', edad=True),
+        dict(base, telefono='5550035'),
+    ]})
+    assert respuesta.status_code == 201
+    cuerpo = respuesta.get_json()
+    assert [r['resultado'] for r in cuerpo['resultados']] == \
+        ['agendada', 'rechazada', 'rechazada', 'rechazada', 'rechazada', 'agendada']
+    assert cuerpo['agendadas'] == 2
+    assert 'sqlite' not in json.dumps(cuerpo)
+
+    with app.app.app_context():
+        telefonos = {p.telefono for p in app.Paciente.query}
+    assert telefonos == {'5550030', '5550035'}
+
+
+def test_lote_no_conserva_pacientes_nuevos_sin_gabinete_tras_el_reintento(app, cliente, monkeypatch):
+    fecha = _proximo_dia_habil()
+    hora = datetime.strptime('15:30:00', '%H:%M:%S').time()
+    with app.app.app_context():
+        app.db.session.execute(app.insert(app.Paciente), [
+            {'nombre': 'Otro', 'apellido': 'Paciente', 'edad': 30, 'telefono': '5559999'}
+        ])
+        app.db.session.commit()
+
+    def lote_en_conflicto(filas):
+        raise IntegrityError('INSERT', {}, Exception('uq_cita_horario_gabinete'))
+
+    # Mientras se reintenta una por una, otra petición ocupa el resto de gabinetes del horario
+    reservar_original = app.reservar_gabinete
+    def reservar_con_competencia(*args, **kwargs):
+        cita = reservar_original(*args, **kwargs)
+        if cita is not None:
+            app.db.session.execute(app.insert(app.Cita), [{
+                'fecha': fecha, 'hora': hora, 'id_paciente': 1, 'id_motivo': 1,
+                'id_gabinete': g, 'estado': 'Programada'
+            } for g in range(cita.id_gabinete + 1, 7)])
+            app.invalidar_ocupacion([(fecha, hora)])
+        return cita
+
+    monkeypatch.setattr(app, '_insertar_citas_lote', lote_en_conflicto)
+    monkeypatch.setattr(app, 'reservar_gabinete', reservar_con_competencia)
+    item = {'fecha': fecha.strftime('%Y-%m-%d'), 'hora': '15:30:00', 'id_motivo': 1,
+            'es_nuevo': True, 'apellido': 'Lote', 'edad': 8}
+    respuesta = cliente.post('/api/citas/agendar_lote', json={'citas': [
+        dict(item, nombre='Gana', telefono='5550020'),
+        dict(item, nombre='Pierde', telefono='5550021'),
+    ]})
+    assert respuesta.status_code == 201
+    assert [r['resultado'] for r in respuesta.get_json()['resultados']] == ['agendada', 'lleno']
+
+    with app.app.app_context():
+        telefonos = {p.telefono for p in app.Paciente.query}
+    assert '5550020' in telefonos and '5550021' not in telefonos
+
+
+def test_importacion_cuenta_cada_fila_una_sola_vez(app, cliente):
+    previo = cliente.post('/api/pacientes/importar', data=b'nombre,apellido,edad,telefono\nYa,Estaba,50,6100009',
+                          content_type='text/csv')
+    assert previo.get_json()['insertadas'] == 1
+
+    csv_texto = '\n'.join([
+        'nombre,apellido,edad,telefono',
+        'Ana,Uno,30,6100001',
+        'Mala,Edad,abc,6100002',
+        'Ana,Dos,31,6100001',      # repetido en el mismo lote: gana esta fila
+        ',SinNombre,20,6100003',
+        'Ya,Actualizado,51,6100009',
+    ])
+    reporte = cliente.post('/api/pacientes/importar', data=csv_texto.encode('utf-8'),
+                           content_type='text/csv').get_json()
+
+    assert reporte['procesadas'] == 5
+    assert (reporte['insertadas'], reporte['actualizadas'], reporte['rechazadas']) == (1, 2, 2)
+    assert reporte['procesadas'] == reporte['insertadas'] + reporte['actualizadas'] + reporte['rechazadas']
+    assert [r['linea'] for r in reporte['rechazos']] == [3, 5]
+
+    with app.app.app_context():
+        apellidos = {p.telefono: p.apellido for p in app.Paciente.query.filter(app.Paciente.telefono.like('61000%'))}
+    assert apellidos == {'6100001': 'Dos', '6100009': 'Actualizado'}
+
+
+def test_sentencia_fallida_no_deja_estado_en_la_conexion(app, base):
+    with app.app.app_context():
+        conexion = app.db.session.connection()
+        antes = {clave: repr(valor) for clave, valor in conexion.info.items()}
+        for _ in range(3):
+            with pytest.raises(IntegrityError):
+                with app.db.session.begin_nested():
+                    app.db.session.execute(app.insert(app.Paciente), [
+                        {'nombre': 'Sin', 'apellido': 'Edad', 'edad': None, 'telefono': '5550040'}
+                    ])
+        assert {clave: repr(valor) for clave, valor in conexion.info.items()} == antes
+        app.db.session.rollback()
+
+
+def test_importacion_interrumpida_informa_lo_ya_guardado(app, cliente, monkeypatch):
+    monkeypatch.setattr(app, 'IMPORTACION_TAMANO_LOTE', 2)
+    filas = ['nombre,apellido,edad,telefono'] + [f'Parcial{i},Prueba,30,62000{i:02d}' for i in range(5)]
+    filas.append('Enorme,' + 'x' * 200000 + ',30,6200099')  # supera csv.field_size_limit
+    respuesta = cliente.post('/api/pacientes/importar', data='\n'.join(filas).encode('utf-8'),
+                             content_type='text/csv')
+
+    # Líneas 2-5 en dos lotes confirmados; la 6 quedó en el lote pendiente y la 7 no se pudo leer
+    assert respuesta.status_code == 400
+    reporte = respuesta.get_json()
+    assert reporte['insertadas'] == 4
+    assert reporte['interrumpida'] == {'ultima_linea_leida': 6, 'reanudar_desde_linea': 6, 'filas_no_guardadas': 1}
+    assert reporte['procesadas'] == reporte['insertadas'] + reporte['actualizadas'] + reporte['rechazadas'] \
+        + reporte['interrumpida']['filas_no_guardadas']
+    with app.app.app_context():
+        assert app.Paciente.query.filter(app.Paciente.telefono.like('62000%')).count() == 4
+
+    # Un fallo de la base en un lote posterior también devuelve el reporte parcial
+    upsert_original = app._upsert_pacientes
+    def upsert_que_falla_al_segundo(filas, llamadas=[]):
+        llamadas.append(1)
+        if len(llamadas) == 2:
+            raise RuntimeError('base no disponible')
+        return upsert_original(filas)
+    monkeypatch.setattr(app, '_upsert_pacientes', upsert_que_falla_al_segundo)
+    filas = ['nombre,apellido,edad,telefono'] + [f'Otro{i},Prueba,30,63000{i:02d}' for i in range(4)]
+    respuesta = cliente.post('/api/pacientes/importar', data='\n'.join(filas).encode('utf-8'),
+                             content_type='text/csv')
+    assert respuesta.status_code == 500
+    reporte = respuesta.get_json()
+    assert reporte['insertadas'] == 2
+    assert reporte['interrumpida'] == {'ultima_linea_leida': 5, 'reanudar_desde_linea': 4, 'filas_no_guardadas': 2}
+
+
+def test_identidad_en_cache_no_consulta_y_se_invalida_al_confirmar_cambios(app, consultas):
+    with app.app.app_context():
+        sesion = app.db.session
+        admin = app.Usuario.query.filter_by(nombre_usuario='admin').one()
+        id_admin, id_rol = admin.id_usuario, admin.id_rol
+
+        primera = app.load_user(str(id_admin))
+        with consultas.medir():
+            assert app.load_user(str(id_admin)) is primera
+        assert consultas.total == 0
+
+        # Cambio en el propio Usuario
+        admin.nombre_usuario = 'admin_renombrado'
+        sesion.commit()
+        assert app.load_user(str(id_admin)).nombre_usuario == 'admin_renombrado'
+
+        # Cambio en su Rol (afecta a todos los usuarios con ese rol)
+        rol = sesion.get(app.Rol, id_rol)
+        nombre_rol = rol.nombre_rol
+        rol.nombre_rol = nombre_rol + '_2'
+        sesion.commit()
+        assert app.load_user(str(id_admin)).nombre_rol == nombre_rol + '_2'
+
+        # Un permiso nuevo asignado a su rol
+        assert 'reportes' not in app.load_user(str(id_admin)).permisos
+        rol.permisos.append(app.Permiso(nombre_permiso='reportes'))
+        sesion.commit()
+        assert 'reportes' in app.load_user(str(id_admin)).permisos
+
+        # Un cambio revertido no descarta la identidad en caché
+        vigente = app.load_user(str(id_admin))
+        admin.nombre_usuario = 'no_confirmado'
+        sesion.flush()
+        sesion.rollback()
+        assert app.load_user(str(id_admin)) is vigente
+
+
+def test_activos_con_huella_se_sirven_inmutables_y_precomprimidos(app, cliente):
+    with open(os.path.join(app.app.root_path, 'funAdmin.js'), 'rb') as archivo:
+        original = archivo.read()
+    huella = hashlib.sha256(original).hexdigest()[:12]
+
+    pagina = cliente.get('/panelAdmin.html')
+    html = pagina.get_data(as_text=True)
+    assert f'src="/activos/funAdmin.{huella}.js"' in html
+    assert 'src="funAdmin.js"' not in html
+    assert re.search(r'href="/activos/estiloAdmin\.[0-9a-f]{12}\.css"', html)
+    assert pagina.headers['Cache-Control'] == 'no-cache'
+
+    ruta = f'/activos/funAdmin.{huella}.js'
+    plano = cliente.get(ruta, headers={'Accept-Encoding': 'identity'})
+    assert plano.status_code == 200 and plano.get_data() == original
+    assert plano.headers['Cache-Control'] == app.CACHE_ACTIVOS
+    assert 'Content-Encoding' not in plano.headers
+    # Un recurso público no debe llevar la cookie de sesión del usuario conectado
+    assert 'Set-Cookie' not in plano.headers
+    assert plano.headers['Vary'] == 'Accept-Encoding'
+
+    comprimido = cliente.get(ruta, headers={'Accept-Encoding': 'gzip'})
+    assert comprimido.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(comprimido.get_data()) == original
+    assert comprimido.headers['ETag'] != plano.headers['ETag']
+
+    revalidado = cliente.get(ruta, headers={'Accept-Encoding': 'gzip', 'If-None-Match': comprimido.headers['ETag']})
+    assert revalidado.status_code == 304 and revalidado.get_data() == b''
+
+    desconocido = cliente.get('/activos/funAdmin.000000000000.js')
+    assert desconocido.status_code == 404
+
+
+def test_catalogo_en_memoria_no_consulta_y_se_recarga_al_confirmar(app, consultas):
+    catalogos = app.catalogos
+    with app.app.app_context():
+        sesion = app.db.session
+        catalogos.invalidar()
+        catalogos.motivos  # carga inicial
+
+        with consultas.medir():
+            assert catalogos.descripcion_motivo(3) == 'Terapia Visual'
+            assert catalogos.nombre_gabinete(1) == 'Gabinete 1'
+            assert catalogos.nombre_rol(1)
+        assert consultas.total == 0
+
+        sesion.get(app.MotivoCita, 3).descripcion = 'Terapia Visual Infantil'
+        sesion.commit()
+        assert catalogos.descripcion_motivo(3) == 'Terapia Visual Infantil'
+
+        # Un cambio revertido no obliga a recargar
+        sesion.get(app.Gabinete, 1).nombre = 'No confirmado'
+        sesion.flush()
+        sesion.rollback()
+        with consultas.medir():
+            assert catalogos.nombre_gabinete(1) == 'Gabinete 1'
+        assert consultas.total == 0
+
+        # Revertir solo un SAVEPOINT conserva el cambio del resto de la transacción
+        sesion.get(app.Gabinete, 1).nombre = 'Gabinete Principal'
+        sesion.flush()
+        with pytest.raises(IntegrityError):
+            with sesion.begin_nested():
+                sesion.add(app.Gabinete(id_gabinete=2, nombre='Duplicado'))
+                sesion.flush()
+        sesion.commit()
+        assert catalogos.nombre_gabinete(1) == 'Gabinete Principal'
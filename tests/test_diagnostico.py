@@ -0,0 +1,102 @@
+# test_diagnostico.py - PRUEBAS DE MÉTRICAS, CONSULTAS LENTAS Y PERFILADO
+
+import json
+import logging
+import re
+
+LINEA_PROMETHEUS = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{[a-z_]+="[^"]*"(,[a-z_]+="[^"]*")*\})? -?[0-9.e+-]+$')
+
+
+def _muestras(texto):
+    """{'nombre{etiquetas}': valor} de un texto de exposición de Prometheus"""
+    muestras = {}
+    for linea in texto.splitlines():
+        if linea.startswith('#'):
+            continue
+        clave, valor = linea.rsplit(' ', 1)
+        muestras[clave] = float(valor)
+    return muestras
+
+
+def test_metrics_en_formato_prometheus_y_contadores_crecen(cliente, sembrar):
+    sembrar(2)
+    cliente.get('/api/citas/todas?limite=5')  # la ruta ya aparece en las métricas
+
+    antes = _muestras(cliente.get('/metrics').get_data(as_text=True))
+    assert cliente.get('/api/citas/todas?limite=5').status_code == 200
+    respuesta = cliente.get('/metrics')
+    texto = respuesta.get_data(as_text=True)
+    despues = _muestras(texto)
+
+    assert respuesta.mimetype == 'text/plain'
+    assert 'version=0.0.4' in respuesta.headers['Content-Type']
+    assert '# TYPE optometria_http_peticion_segundos histogram' in texto
+    assert '# TYPE optometria_http_respuestas_total counter' in texto
+    for linea in texto.splitlines():
+        assert linea.startswith('# TYPE ') or LINEA_PROMETHEUS.match(linea), linea
+
+    ruta = 'ruta="/api/citas/todas",metodo="GET"'
+    respuestas = f'optometria_http_respuestas_total{{{ruta},codigo="200"}}'
+    assert despues[respuestas] == antes[respuestas] + 1
+    conteo = f'optometria_http_peticion_segundos_count{{{ruta}}}'
+    assert despues[conteo] == antes[conteo] + 1
+    assert despues[f'optometria_http_peticion_segundos_bucket{{{ruta},le="+Inf"}}'] == despues[conteo]
+    sentencias = f'optometria_sql_sentencias_total{{{ruta}}}'
+    assert despues[sentencias] > antes[sentencias]
+    assert despues[f'optometria_sql_segundos_total{{{ruta}}}'] > antes[f'optometria_sql_segundos_total{{{ruta}}}']
+
+
+class _Captura(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.mensajes = []
+
+    def emit(self, registro):
+        self.mensajes.append(registro.getMessage())
+
+
+def test_consulta_lenta_se_registra_con_parametros_redactados(app, cliente, monkeypatch):
+    # Se restauran al terminar aunque la prueba los cambie por la API
+    monkeypatch.setitem(app.diagnostico, 'sql_lenta_umbral_ms', app.diagnostico['sql_lenta_umbral_ms'])
+    app.consultas_lentas.clear()
+    captura = _Captura()
+    logging.getLogger('optometria').addHandler(captura)
+    try:
+        assert cliente.put('/api/diagnostico/configuracion', json={'sql_lenta_umbral_ms': 10 ** 6}).status_code == 200
+        cliente.post('/api/paciente/buscar', json={'telefono': '5557654321'})
+        assert cliente.get('/api/diagnostico/consultas_lentas').get_json()['consultas'] == []
+
+        assert cliente.put('/api/diagnostico/configuracion', json={'sql_lenta_umbral_ms': 0}).status_code == 200
+        cliente.post('/api/paciente/buscar', json={'telefono': '5557654321'})
+    finally:
+        logging.getLogger('optometria').removeHandler(captura)
+
+    registradas = cliente.get('/api/diagnostico/consultas_lentas').get_json()['consultas']
+    busqueda = [c for c in registradas if c['ruta'] == 'POST /api/paciente/buscar' and 'paciente.telefono' in c['sentencia']]
+    assert busqueda, registradas
+    assert '5557654321' not in json.dumps(registradas)
+    assert "'<str>'" in busqueda[0]['parametros']
+    assert busqueda[0]['duracion_ms'] >= 0
+    assert any(m.startswith('SQL lenta') and 'POST /api/paciente/buscar' in m for m in captura.mensajes)
+    assert not any('5557654321' in m for m in captura.mensajes)
+
+
+def test_perfilado_solo_con_cabecera_y_sesion(app, base, cliente, monkeypatch):
+    monkeypatch.setitem(app.diagnostico, 'perfil_tasa_muestreo', 0)
+    app.perfiles_guardados.clear()
+
+    cliente.get('/api/citas/todas?limite=5')
+    base.app.test_client().get('/api/citas/todas?limite=5', headers={app.PERFIL_CABECERA: '1'})
+    assert cliente.get('/api/diagnostico/perfiles').get_json()['perfiles'] == []
+
+    respuesta = cliente.get('/api/citas/todas?limite=5', headers={app.PERFIL_CABECERA: '1'})
+    assert respuesta.status_code == 200
+    perfiles = cliente.get('/api/diagnostico/perfiles').get_json()['perfiles']
+    assert len(perfiles) == 1
+    perfil = perfiles[0]
+    assert (perfil['ruta'], perfil['codigo'], perfil['motivo']) == ('GET /api/citas/todas', 200, 'cabecera')
+    funciones = perfil['funciones']
+    assert 0 < len(funciones) <= app.diagnostico['perfil_top_n']
+    assert any('get_citas_todas' in f['funcion'] or 'app.py' in f['funcion'] for f in funciones)
+    acumulados = [f['tiempo_acumulado_ms'] for f in funciones]
+    assert acumulados == sorted(acumulados, reverse=True)
@@ -0,0 +1,129 @@
+# test_rendimiento.py - PRESUPUESTOS DE CONSULTAS SQL Y TIEMPO POR ENDPOINT
+#
+# Cada escenario declara cuántas sentencias SQL y cuántos segundos puede costar con
+# los datos sembrados. Si un cambio reintroduce cargas perezosas por fila o un COUNT
+# por horario, el número de consultas crece con los datos y la prueba falla.
+
+from datetime import date, timedelta
+
+import pytest
+
+# Tamaños de agenda (días de citas) con los que se mide cada endpoint
+TAMANOS = [10, 250]
+
+
+def _proximo_dia_habil(dias=1):
+    fecha = date.today() + timedelta(days=dias)
+    while fecha.weekday() >= 5:
+        fecha += timedelta(days=1)
+    return fecha.strftime('%Y-%m-%d')
+
+
+def _semana_actual():
+    hoy = date.today()
+    return f'desde={hoy:%Y-%m-%d}&hasta={hoy + timedelta(days=6):%Y-%m-%d}'
+
+
+# (nombre, método, ruta o función que la construye, cuerpo, máx. consultas, máx. segundos)
+PRESUPUESTOS = [
+    ('todas', 'GET', lambda: '/api/citas/todas', None, 4, 5.0),
+    ('todas_semana', 'GET', lambda: f'/api/citas/todas?{_semana_actual()}', None, 4, 1.0),
+    ('admin_completo', 'GET', lambda: '/api/citas/admin_completo', None, 4, 5.0),
+    ('reporte_semanal', 'GET', lambda: '/api/reportes/semanal', None, 10, 1.0),
+    ('disponibilidad', 'POST', lambda: '/api/citas/disponibilidad', lambda: {'fecha': _proximo_dia_habil()}, 2, 0.5),
+    ('agendar_terapia', 'POST', lambda: '/api/citas/agendar_terapia', lambda: {
+        'nombre_paciente': 'Ana Prueba', 'fecha_inicio': _proximo_dia_habil(), 'hora': '12:30:00',
+        'telefono': '5550001'
+    }, 26, 1.0),
+    ('agendar_lote', 'POST', lambda: '/api/citas/agendar_lote', lambda: {'citas': [
+        {'fecha': _proximo_dia_habil(), 'hora': hora, 'id_motivo': 1, 'es_nuevo': True,
+         'nombre': f'Lote{i}', 'apellido': 'Prueba', 'edad': 9, 'telefono': f'555{i:04d}'}
+        for i, hora in enumerate(['12:30:00', '13:30:00', '14:30:00', '15:30:00'] * 3)
+    ]}, 16, 1.0),
+]
+
+
+def _ejecutar(cliente, metodo, ruta, cuerpo):
+    respuesta = cliente.open(ruta(), method=metodo, json=cuerpo() if cuerpo else None)
+    respuesta.get_data()  # incluye el tiempo de las respuestas en streaming
+    return respuesta
+
+
+@pytest.mark.parametrize('dias', TAMANOS)
+@pytest.mark.parametrize('nombre,metodo,ruta,cuerpo,max_consultas,max_segundos', PRESUPUESTOS,
+                         ids=[p[0] for p in PRESUPUESTOS])
+def test_presupuesto_endpoint(cliente, consultas, sembrar, dias,
+                              nombre, metodo, ruta, cuerpo, max_consultas, max_segundos):
+    sembrar(dias)
+
+    with consultas.medir():
+        respuesta = _ejecutar(cliente, metodo, ruta, cuerpo)
+
+    assert respuesta.status_code in (200, 201), respuesta.get_data(as_text=True)
+    assert consultas.total <= max_consultas, (
+        f'{nombre}: {consultas.total} consultas (presupuesto {max_consultas}) con {dias} días:\n'
+        + '\n'.join(s.split('\n')[0] for s in consultas.sentencias)
+    )
+    assert consultas.segundos <= max_segundos, (
+        f'{nombre}: {consultas.segundos:.3f}s (presupuesto {max_segundos}s) con {dias} días'
+    )
+
+
+@pytest.mark.parametrize('nombre,metodo,ruta,cuerpo', [p[:4] for p in PRESUPUESTOS],
+                         ids=[p[0] for p in PRESUPUESTOS])
+def test_consultas_no_crecen_con_los_datos(app, nombre, metodo, ruta, cuerpo, sembrar, cliente, consultas):
+    """El número de consultas debe ser el mismo con una agenda pequeña y una grande."""
+    totales = []
+    for dias in TAMANOS:
+        with app.app.app_context():
+            app.db.drop_all()
+        app.invalidar_ocupacion()
+        app.inicializar_db()
+        cliente.post('/login', json={'username': 'admin', 'password': 'adminUAL'})
+        sembrar(dias)
+        with consultas.medir():
+            respuesta = _ejecutar(cliente, metodo, ruta, cuerpo)
+        assert respuesta.status_code in (200, 201)
+        totales.append(consultas.total)
+
+    assert len(set(totales)) == 1, f'{nombre}: consultas por tamaño {dict(zip(TAMANOS, totales))}'
+
+
+def test_recurrencia_no_depende_del_numero_de_semanas(cliente, consultas, sembrar):
+    """Una serie de terapia completa (13 citas) cuesta lo mismo que una cita individual más un margen fijo."""
+    sembrar(5)
+    cuerpo = {'nombre_paciente': 'Serie Prueba', 'fecha_inicio': _proximo_dia_habil(), 'hora': '13:30:00'}
+
+    with consultas.medir():
+        individual = cliente.post('/api/citas/agendar_terapia',
+                                  json=dict(cuerpo, telefono='5550002', es_recurrente=False))
+    consultas_individual = consultas.total
+
+    with consultas.medir():
+        serie = cliente.post('/api/citas/agendar_terapia',
+                             json=dict(cuerpo, telefono='5550003', fecha_inicio=_proximo_dia_habil(2)))
+
+    assert individual.status_code == 201 and serie.status_code == 201
+    assert serie.get_json()['total_citas'] == 13
+    assert consultas.total - consultas_individual <= 8
+
+
+def test_importacion_pacientes_por_lotes(cliente, consultas):
+    """Importar pacientes cuesta un número fijo de sentencias por lote, no por fila."""
+    def csv_pacientes(inicio, total):
+        filas = ['nombre,apellido,edad,telefono'] + [
+            f'Imp{i},Prueba,{i % 90},{6000000 + i}' for i in range(inicio, inicio + total)
+        ]
+        return '\n'.join(filas).encode('utf-8')
+
+    cliente.get('/api/user/current')  # deja la identidad del usuario en caché antes de medir
+    totales = []
+    for inicio, total in [(0, 10), (10, 900)]:
+        with consultas.medir():
+            respuesta = cliente.post('/api/pacientes/importar', data=csv_pacientes(inicio, total),
+                                     content_type='text/csv')
+        assert respuesta.status_code == 200
+        assert respuesta.get_json()['insertadas'] == total
+        totales.append(consultas.total)
+
+    assert totales[0] == totales[1], f'sentencias por tamaño de importación: {totales}'
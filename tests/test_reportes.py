@@ -0,0 +1,145 @@
+# test_reportes.py - PRUEBAS DE REPORTES, EXPORTACIÓN Y DISPONIBILIDAD
+
+import csv
+import io
+import json
+from datetime import date, datetime, timedelta
+
+
+def _citas_entre(app, desde, hasta):
+    """(id_cita, fecha, hora) de las citas del rango, en el orden de los listados"""
+    with app.app.app_context():
+        Cita = app.Cita
+        return [
+            (c.id_cita, c.fecha.strftime('%Y-%m-%d'), str(c.hora))
+            for c in Cita.query.filter(Cita.fecha.between(desde, hasta))
+            .order_by(Cita.fecha, Cita.hora, Cita.id_cita)
+        ]
+
+
+def test_exportacion_csv_y_jsonl_en_streaming(app, cliente, sembrar):
+    sembrar(6)
+    hoy = date.today()
+    desde, hasta = hoy - timedelta(days=1), hoy + timedelta(days=1)
+    esperadas = _citas_entre(app, desde, hasta)
+    assert esperadas
+    rango = f'desde={desde:%Y-%m-%d}&hasta={hasta:%Y-%m-%d}'
+
+    respuesta = cliente.get(f'/api/reportes/export?{rango}')
+    assert respuesta.status_code == 200
+    assert respuesta.mimetype == 'text/csv'
+    assert respuesta.headers['Content-Disposition'] == \
+        f'attachment; filename="citas_{desde:%Y%m%d}_{hasta:%Y%m%d}.csv"'
+    # En streaming: el tamaño no se conoce de antemano
+    assert respuesta.is_streamed and 'Content-Length' not in respuesta.headers
+    filas = list(csv.reader(io.StringIO(respuesta.get_data(as_text=True))))
+    assert filas[0] == app.COLUMNAS_EXPORTACION
+    assert [(int(f[0]), f[1], f[2]) for f in filas[1:]] == esperadas
+    assert all(f[3].endswith(' Prueba') and f[7] == 'Programada' for f in filas[1:])
+
+    respuesta = cliente.get(f'/api/reportes/export?{rango}&formato=jsonl')
+    assert respuesta.status_code == 200
+    assert respuesta.mimetype == 'application/x-ndjson'
+    assert respuesta.headers['Content-Disposition'].endswith('.jsonl"')
+    lineas = [json.loads(l) for l in respuesta.get_data(as_text=True).splitlines()]
+    assert [(l['id_cita'], l['fecha'], l['hora']) for l in lineas] == esperadas
+    assert set(lineas[0]) == set(app.COLUMNAS_EXPORTACION)
+
+    # Los filtros del listado también se aplican a la exportación
+    respuesta = cliente.get(f'/api/reportes/export?{rango}&formato=jsonl&gabinete=2')
+    lineas = [json.loads(l) for l in respuesta.get_data(as_text=True).splitlines()]
+    assert lineas and {l['gabinete'] for l in lineas} == {'Gabinete 2'}
+
+
+def test_exportacion_rechaza_parametros_invalidos(cliente):
+    hoy = date.today()
+    casos = [
+        '',
+        f'desde={hoy:%Y-%m-%d}',
+        f'hasta={hoy:%Y-%m-%d}',
+        f'desde={hoy:%Y-%m-%d}&hasta={hoy - timedelta(days=1):%Y-%m-%d}',
+        f'desde={hoy:%Y-%m-%d}&hasta={hoy:%Y-%m-%d}&formato=xlsx',
+        f'desde=ayer&hasta={hoy:%Y-%m-%d}',
+    ]
+    for parametros in casos:
+        respuesta = cliente.get(f'/api/reportes/export?{parametros}')
+        assert respuesta.status_code == 400, parametros
+        assert respuesta.get_json()['message']
+
+
+def test_resumen_semanal_coincide_con_las_citas_sembradas(app, cliente, sembrar):
+    sembrar(6)
+    hoy = date.today()
+    with app.app.app_context():
+        Cita = app.Cita
+        app.db.session.execute(app.update(Cita).where(
+            Cita.fecha == hoy - timedelta(days=1), Cita.id_gabinete == 1).values(estado='No asistió'))
+        app.db.session.execute(app.update(Cita).where(
+            Cita.fecha == hoy - timedelta(days=2), Cita.id_gabinete.in_([2, 3])).values(estado='Cancelada'))
+        app.db.session.commit()
+        citas = Cita.query.filter(Cita.fecha.between(hoy - timedelta(days=6), hoy)).all()
+        esperado = {'por_estado': {}, 'por_motivo': {}, 'por_gabinete': {}, 'por_hora': {}, 'por_dia_semana': {}}
+        for c in citas:
+            for grupo, clave in (('por_estado', c.estado),
+                                 ('por_motivo', app.catalogos.descripcion_motivo(c.id_motivo)),
+                                 ('por_gabinete', app.catalogos.nombre_gabinete(c.id_gabinete)),
+                                 ('por_hora', str(c.hora)),
+                                 ('por_dia_semana', app.DIAS_SEMANA[c.fecha.weekday()])):
+                esperado[grupo][clave] = esperado[grupo].get(clave, 0) + 1
+
+    completo = cliente.get('/api/reportes/semanal').get_json()
+    resumen = completo['resumen']
+    assert resumen['total'] == completo['total'] == len(citas) == len(completo['citas'])
+    for grupo, valores in esperado.items():
+        assert resumen[grupo] == valores, grupo
+    # 4 días sembrados dentro de la ventana x 4 horarios x 3 gabinetes
+    assert len(citas) == 48
+    assert resumen['por_estado'] == {'Programada': 36, 'No asistió': 4, 'Cancelada': 8}
+    assert resumen['tasa_inasistencia'] == round(esperado['por_estado']['No asistió'] / len(citas), 4)
+    assert resumen['tasa_cancelacion'] == round(esperado['por_estado']['Cancelada'] / len(citas), 4)
+
+    solo = cliente.get('/api/reportes/semanal?solo_resumen=1').get_json()
+    assert 'citas' not in solo
+    assert solo['resumen'] == resumen and solo['total'] == len(citas)
+    assert (solo['fecha_inicio'], solo['fecha_fin']) == (completo['fecha_inicio'], completo['fecha_fin'])
+
+
+def test_disponibilidad_del_mes_coincide_con_la_del_dia(app, cliente, sembrar):
+    hoy = date.today()
+    sembrar(4, por_horario=6)  # días completos alrededor de hoy
+    with app.app.app_context():
+        # Un horario con solo dos gabinetes ocupados, en el primer día hábil tras los sembrados
+        parcial = hoy + timedelta(days=3)
+        while parcial.weekday() >= 5:
+            parcial += timedelta(days=1)
+        app.db.session.execute(app.insert(app.Cita), [{
+            'fecha': parcial, 'hora': datetime.strptime('12:30:00', '%H:%M:%S').time(),
+            'id_paciente': 1, 'id_motivo': 1, 'id_gabinete': g, 'estado': 'Programada'
+        } for g in (1, 2)])
+        app.db.session.commit()
+
+    mes = f'{parcial:%Y-%m}'
+    respuesta = cliente.post('/api/citas/disponibilidad/rango', json={'mes': mes})
+    assert respuesta.status_code == 200
+    cuerpo = respuesta.get_json()
+    assert cuerpo['total_gabinetes'] == len(app.Config.GABINETES)
+    assert cuerpo['disponibilidad'][f'{parcial:%Y-%m-%d}']['12:30:00'] == len(app.Config.GABINETES) - 2
+
+    dias = cuerpo['disponibilidad']
+    assert all(k[:7] == mes for k in dias)
+    for fecha, libres in dias.items():
+        if date.fromisoformat(fecha).weekday() >= 5:
+            assert libres == {}, fecha
+            continue
+        por_dia = cliente.post('/api/citas/disponibilidad', json={'fecha': fecha}).get_json()['disponibilidad']
+        assert set(libres) == set(por_dia) == set(app.Config.HORARIOS_ATENCION)
+        for hora, estado in por_dia.items():
+            assert (libres[hora] > 0) == (estado == 'Disponible'), (fecha, hora)
+
+
+def test_disponibilidad_del_mes_rechaza_rangos_invalidos(cliente):
+    for cuerpo in [{}, {'mes': ''}, {'mes': '2025-13'}, {'mes': 'enero'}, {'mes': 202501},
+                   {'mes': '2025-01-15'}, {'mes': '2025-01/2025-06'}]:
+        respuesta = cliente.post('/api/citas/disponibilidad/rango', json=cuerpo)
+        assert respuesta.status_code == 400, cuerpo
+        assert respuesta.get_json()['message']